@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import base64
 import io
+import os
 
 import dash
 import dash_auth
@@ -10,7 +11,7 @@ import dash_core_components as dcc
 import dash_daq as daq
 import dash_bootstrap_components as dbc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
 from plotly.subplots import make_subplots
 import plotly.graph_objects as go
 import plotly.express as px
@@ -66,20 +67,22 @@ server = app.server
 #  'Min Date',
 #  'Max Date']
 dates = ['Batch Completion Date', 'First Formulated Consumed Material', 'TO.80 Log Date']
-production_df = pd.read_csv('data/test.csv', parse_dates=dates)
-# whole_df = pd.read_csv('data/Cleveland.csv', parse_dates=dates)
-descriptors = ['Family', 'Tank Number',
-       'Cost Center', 'Technology', 'Product', 'Parent Batch Actual Qty', 'Site']
 time_components = ['PA Time',
  'Tot. CM Time',
  '80 appv.',
  'Filling Time',
  'Tot. Time']
-time_components = production_df.columns[6:11]
-for col in time_components:
-    production_df[col] = pd.to_timedelta(production_df[col])
+production_df = get_dataset(ingest_preset('data/test.csv', dates, time_components))
+# whole_df = pd.read_csv('data/Cleveland.csv', parse_dates=dates)
+descriptors = ['Family', 'Tank Number',
+       'Cost Center', 'Technology', 'Product', 'Parent Batch Actual Qty', 'Site']
 time_column = time_components[-1]
 volume_column = 'Parent Batch Actual Qty'
+quant_targets = [0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95]
+# generated datasets offered next to the presets for load testing, e.g.
+# PPG_SYNTHETIC_ROWS=100000,1000000
+synthetic_rows = [int(rows) for rows in
+                  os.environ.get('PPG_SYNTHETIC_ROWS', '').split(',') if rows]
 margin_column = "{} By {}".format(volume_column, time_column)
 production_df[margin_column] = production_df[volume_column] /\
     (production_df[time_components[-1]].dt.total_seconds()/60/60)
@@ -91,33 +94,48 @@ production_df = production_df.loc[production_df[margin_column] < 1e2]
 
 
 # production_df[descriptors] = production_df[descriptors].astype(str)
-production_json = production_df.to_json()
-
-def find_opportunity(df,
-                     groupby_primary = "Cost Center",
-                     groupby_secondary = "Technology",
-                     groupby_tertiary = "Tank Number",
-                     time_column=time_components[3],
-                     volume_column='Parent Batch Actual Qty',
-                     quant_target=0.75):
-    groups=3
-    if type(df.iloc[-1][time_column]) == pd._libs.tslibs.timedeltas.Timedelta:
-        df[time_column] = df[time_column].dt.total_seconds()/60/60
-    margin_column = "{} By {}".format(volume_column, time_column)
-    groupby = [groupby_primary, groupby_secondary, groupby_tertiary]
-    df.loc[:, margin_column] = df[volume_column] / df[time_column]
-    df = df.loc[df[[margin_column, volume_column, time_column]].notnull().all(axis=1)]
-    # desc = df.groupby(groupby)[margin_column].quantile([0.5,quant_target]).unstack(level=groups)
-    desc = df.groupby(groupby)[margin_column].describe()[['50%', '75%']]
-    totals = df.groupby(groupby)[volume_column, time_column].agg(['sum', 'std', 'mean'])
-    count = df.groupby(groupby)[volume_column].agg(['count'])
-    count.columns = ['Count']
-    desc = desc.join(totals).dropna()
-    desc = desc.join(count)
-    desc['Volume Opportunity, Gal'] = (desc[volume_column, 'sum'] / desc['50%'] * desc['75%']) - desc[volume_column, 'sum']
-    desc['Time Opportunity, Hours'] = desc[time_column, 'sum'] - (desc[time_column, 'sum'] / desc['75%'] * desc['50%'])
-    desc = desc.sort_values(by=[('Time Opportunity, Hours')], ascending=False)
-    return desc
+production_id = register_dataset(production_df)
+
+def relayout_range(relayoutData):
+    """
+    zoomed x-range of a time axis from a graph's relayoutData, None when
+    the axis shows everything
+    """
+    if (relayoutData is None) or relayoutData.get('xaxis.autorange'):
+        return None
+    if 'xaxis.range' in relayoutData:
+        start, end = relayoutData['xaxis.range']
+    elif 'xaxis.range[0]' in relayoutData:
+        start, end = relayoutData['xaxis.range[0]'], relayoutData['xaxis.range[1]']
+    else:
+        return None
+    return pd.to_datetime(start), pd.to_datetime(end)
+
+def kde_violin(values, name, position, height=0.9, points=200):
+    """
+    one-sided violin drawn from a server-side density curve at y=position,
+    so the figure carries at most `points` points per group instead of
+    every sample; the mean line and summary stats are part of the same trace.
+    Groups with no more than `points` samples are cheaper as plain violins
+    and are drawn as one at the same position
+    """
+    if len(values) <= points:
+        return go.Violin(x=values, y0=position, name=name,
+                         side='positive', width=2 * height)
+    grid, density = kde_curve(values, points)
+    decimals = max(0, 2 - int(np.floor(np.log10(grid[1] - grid[0]))))
+    grid = np.round(grid, decimals)
+    density = np.round(position + density / density.max() * height, 3)
+    mean = np.mean(values)
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    x = np.concatenate([[grid[0]], grid, [grid[-1], None, round(mean, decimals),
+                        round(mean, decimals)]])
+    y = np.concatenate([[position], density, [position, None, position,
+                        round(np.interp(mean, grid, density), 3)]])
+    return go.Scatter(x=x, y=y, name=name, fill='toself', hoveron='fills',
+        mode='lines', line=dict(width=1),
+        text='N: {}, Mean: {:.0f}, Median: {:.0f}, Q1: {:.0f}, Q3: {:.0f}'.format(
+            len(values), mean, median, q1, q3))
 
 def make_primary_plot(production_df,
                    margin_column,
@@ -133,7 +151,8 @@ def make_primary_plot(production_df,
                    sort_by='mean',
                    data_type='Rate (Gal/Hr)',
                    quant=[0.02, 0.997],
-                   dist_cutoff=2):
+                   dist_cutoff=2,
+                   kde=False):
     ### Preprocessing
     if (data_type == 'Rate (Gal/Hr)') and (chart_type != 'Parallel Coordinates (Time)'):
         margin_column = "{} By {} (Gal/Hr)".format(volume_column, time_column)
@@ -152,7 +171,7 @@ def make_primary_plot(production_df,
 
     ### Charts
     if chart_type == 'Parallel Coordinates (Time)':
-        df = production_df.groupby(groupby_primary)[time_components].agg(lambda x: x.median())
+        df = production_df.groupby(groupby_primary, observed=True)[time_components].agg(lambda x: x.median())
         df = df.reset_index()
         for col in time_components:
             df[col] = df[col].dt.total_seconds()/60/60
@@ -195,19 +214,19 @@ def make_primary_plot(production_df,
                     data)
         else:
             if margin_column == volume_column:
-                dff = pd.DataFrame(production_df.groupby(groupby)[[margin_column]]\
+                dff = pd.DataFrame(production_df.groupby(groupby, observed=True)[[margin_column]]\
                      .median().sort_values(by=margin_column, ascending=False)).reset_index()
             else:
-                dff = pd.DataFrame(production_df.groupby(groupby)[[margin_column, volume_column]]\
+                dff = pd.DataFrame(production_df.groupby(groupby, observed=True)[[margin_column, volume_column]]\
                      .median().sort_values(by=margin_column, ascending=False)).reset_index()
-            dff['median'] = dff.groupby(groupby[-1])[margin_column].\
+            dff['median'] = dff.groupby(groupby[-1], observed=True)[margin_column].\
                     transform('median')
 
             dff = dff.sort_values(['median', margin_column],
                 ascending=False).reset_index(drop=True)
             dff = dff[dff.columns[:-1]]
             if groupby_primary == 'Cost Center':
-                dff[groupby_primary] = '_' + dff[groupby_primary]
+                dff[groupby_primary] = '_' + dff[groupby_primary].astype(str)
 
             fig = go.Figure()
             for data in px.scatter(
@@ -226,52 +245,55 @@ def make_primary_plot(production_df,
         groupby = [i for i in groupby if 'None' not in i]
         fig = go.Figure()
         if len(groupby) != 0:
-            dff = pd.DataFrame(production_df.groupby(groupby)[[margin_column]]\
+            grouped = production_df.groupby(groupby, observed=True)
+            dff = pd.DataFrame(grouped[[margin_column]]\
                              .median().sort_values(by=margin_column, ascending=False)).reset_index()
-            dff['median'] = dff.groupby(groupby[0])[margin_column].\
+            dff['median'] = dff.groupby(groupby[0], observed=True)[margin_column].\
                     transform('median')
 
             dff = dff.sort_values(['median', margin_column],
                 ascending=False).reset_index(drop=True)
             dff = dff[dff.columns[:-1]]
-            for index in dff.index:
-                if len(groupby) == 2:
-                    trace = production_df.loc[(production_df[groupby_primary] == dff[groupby_primary][index]) &
-                             (production_df[groupby_secondary] == dff[groupby_secondary][index])]
-                    name = 'N: {}, Avg: {:.0f}, {}, {}'.format(trace.shape[0], dff[margin_column][index],
-                        dff[groupby_primary][index], dff[groupby_secondary][index])
-                elif len(groupby) == 1:
-                    trace = production_df.loc[(production_df[groupby[0]] == dff[groupby[0]][index])]
-
-                    name = 'N: {}, Avg: {:.0f}, {}'.format(trace.shape[0], dff[margin_column][index],
-                        dff[groupby[0]][index])
-
-                trace["Site"] = " "
-                if trace.shape[0] > dist_cutoff:
-                    fig.add_trace(go.Violin(x=trace[margin_column],
-                                      y=trace["Site"],
+            # row positions of every group from the same pass as the medians
+            indices = grouped.indices
+            margin = production_df[margin_column].values
+            for row in dff[groupby + [margin_column]].itertuples(index=False):
+                labels = list(row[:-1])
+                values = margin[indices[tuple(labels) if len(groupby) == 2 else labels[0]]]
+                name = ', '.join(['N: {}, Avg: {:.0f}'.format(values.shape[0], row[-1])] +
+                                 ['{}'.format(i) for i in labels])
+                if (values.shape[0] > dist_cutoff) and kde:
+                    fig.add_trace(kde_violin(values, name, -len(fig.data)))
+                elif values.shape[0] > dist_cutoff:
+                    fig.add_trace(go.Violin(x=values,
+                                      y=np.full(values.shape[0], " "),
                                       name=name,
                                     side='positive'))
         else:
             trace = production_df
             name = 'N: {}, Avg: {:.0f}'.format(trace.shape[0], trace[margin_column].median())
-            if trace.shape[0] > dist_cutoff:
+            if (trace.shape[0] > dist_cutoff) and kde:
+                fig.add_trace(kde_violin(trace[margin_column].values, name, 0))
+            elif trace.shape[0] > dist_cutoff:
                 fig.add_trace(go.Violin(x=trace[margin_column],
                                   y=trace["Site"],
                                   name=name,
                                 side='positive'))
-        fig.update_traces(meanline_visible=True, orientation='h')
+        fig.update_traces(meanline_visible=True, orientation='h',
+                          selector=dict(type='violin'))
         fig.update_xaxes(rangemode="nonnegative")
+        if kde:
+            fig.update_yaxes(showticklabels=False)
 
 
     elif "vs" in margin_column:
         margin_column = '{} (% by {}, {})'\
                        .format(margin_column, groupby_primary, groupby_secondary)
-        dff = pd.DataFrame(((production_df.groupby([groupby_primary, groupby_secondary])\
+        dff = pd.DataFrame(((production_df.groupby([groupby_primary, groupby_secondary], observed=True)\
                              ['Actual Qty In (KLG)'].sum() -
-                         production_df.groupby([groupby_primary, groupby_secondary])\
+                         production_df.groupby([groupby_primary, groupby_secondary], observed=True)\
                              ['Planned Qty In (KLG)'].sum()) /
-                         production_df.groupby([groupby_primary, groupby_secondary])\
+                         production_df.groupby([groupby_primary, groupby_secondary], observed=True)\
                             ['Planned Qty In (KLG)'].sum()) * 100).reset_index()
         dff.columns = [groupby_primary, groupby_secondary, margin_column]
         fig = px.bar(dff, dff[groupby_primary],
@@ -332,7 +354,10 @@ def make_secondary_plot(production_df,
                    quant=[0.02, 0.98],
                    dist_cutoff=2,
                    start_date='First Formulated Consumed Material',
-                   end_date='TO.80 Log Date'):
+                   end_date='TO.80 Log Date',
+                   webgl=False,
+                   x_range=None,
+                   max_points=2000):
     ### Preprocessing
     if (data_type == 'Rate (Gal/Hr)') and (chart_type != 'Parallel Coordinates (Time)'):
         margin_column = "{} By {} (Gal/Hr)".format(volume_column, time_column)
@@ -357,53 +382,52 @@ def make_secondary_plot(production_df,
                   '#FF6692', '#B6E880', '#FF97FF', '#FECB52']
         colors_cycle = cycle(colors)
 
-        dff = pd.DataFrame(production_df.groupby(groupby)[[margin_column]]\
+        grouped = production_df.groupby(groupby, observed=True)
+        dff = pd.DataFrame(grouped[[margin_column]]\
                              .median().sort_values(by=margin_column, ascending=False)).reset_index()
-        dff['median'] = dff.groupby(groupby[0])[margin_column].\
+        dff['median'] = dff.groupby(groupby[0], observed=True)[margin_column].\
                 transform('median')
 
         dff = dff.sort_values(['median', margin_column],
             ascending=False).reset_index(drop=True)
         dff = dff[dff.columns[:-1]]
         fig = go.Figure()
-        for index in dff.index:
-            if len(groupby) == 2:
-                trace = production_df.loc[(production_df[groupby_primary] == dff[groupby_primary][index]) &
-                         (production_df[groupby_secondary] == dff[groupby_secondary][index])]
-                name = 'N: {}, Avg: {:.0f}, {}, {}'.format(trace.shape[0], dff[margin_column][index],
-                    dff[groupby_primary][index], dff[groupby_secondary][index])
-            elif len(groupby) == 1:
-                trace = production_df.loc[(production_df[groupby[0]] == dff[groupby[0]][index])]
-
-                name = 'N: {}, Avg: {:.0f}, {}'.format(trace.shape[0], dff[margin_column][index],
-                    dff[groupby[0]][index])
-
-            trace["Site"] = " "
-            if trace.shape[0] > dist_cutoff:
-                trace = trace.reset_index(drop=True)
+        # one trace per group, batches are segments separated by gaps
+        scatter = go.Scattergl if webgl else go.Scatter
+        indices = grouped.indices
+        start = production_df[start_date].values
+        end = production_df[end_date].values
+        margin = production_df[margin_column].values
+        for row in dff[groupby + [margin_column]].itertuples(index=False):
+            labels = list(row[:-1])
+            index = indices[tuple(labels) if len(groupby) == 2 else labels[0]]
+            name = ', '.join(['N: {}, Avg: {:.0f}'.format(index.shape[0], row[-1])] +
+                             ['{}'.format(i) for i in labels])
+            if index.shape[0] > dist_cutoff:
                 color = next(colors_cycle)
-                for sub_index in trace.index:
-                    x1 = trace[start_date][sub_index]
-                    x2 = trace[end_date][sub_index]
-                    y1 = trace[margin_column][sub_index]
-                    y2 = trace[margin_column][sub_index]
-                    if sub_index == 0:
-                        legend = True
-                    else:
-                        legend = False
-                    fig.add_trace(go.Scatter(x=[x1, x2],
-                                          y=[y1, y2],
-                                          name=name,
-                                             showlegend=legend,
-                                             legendgroup=name,
-                                            marker=dict(size=8, color=[color, color]),
-                                             line=dict(color=color),
-
-                                            mode='lines+markers'))
+                x, y = segment_arrays(start[index], end[index], margin[index])
+                fig.add_trace(scatter(x=x,
+                                      y=y,
+                                      name=name,
+                                      legendgroup=name,
+                                      marker=dict(size=8, color=color),
+                                      line=dict(color=color),
+                                      mode='lines+markers'))
     else:
         production_df = production_df.sort_values(dates[-1]).reset_index()
-        fig = px.scatter(production_df.loc[production_df[groupby[0]].dropna().index],
+        production_df = production_df.loc[production_df[groupby[0]].dropna().index]
+        if x_range is not None:
+            production_df = production_df.loc[(production_df[dates[-1]] >= x_range[0]) &
+                                               (production_df[dates[-1]] <= x_range[1])]
+        if production_df.shape[0] > max_points:
+            # level of detail, re-queried when the x-range narrows
+            codes, _ = factorize_groups(production_df, [groupby[0]])
+            production_df = production_df.iloc[downsample_minmax(
+                production_df[dates[-1]].values, production_df[volume_column].values,
+                max_points, codes)]
+        fig = px.scatter(production_df,
               x=dates[-1], y=volume_column, color=groupby[0])
+        fig.update_layout(uirevision=groupby[0])
     fig.update_layout({
                 "plot_bgcolor": "#FFFFFF",
                 "paper_bgcolor": "#FFFFFF",
@@ -485,7 +509,8 @@ def make_results_distribution(df,
                  data_type='Rate (Gal/Hr)',
                  volume_column='Parent Batch Actual Qty',
                  quant_target=0.75,
-                 dist_cutoff = 1):
+                 dist_cutoff = 1,
+                 kde=False):
     groups = 3
     ### Preprocessing
     if (data_type == 'Rate (Gal/Hr)'):
@@ -505,9 +530,9 @@ def make_results_distribution(df,
 #     return desc
 
 
-    dff = pd.DataFrame(df.groupby(groupby)[[margin_column]]\
+    dff = pd.DataFrame(df.groupby(groupby, observed=True)[[margin_column]]\
                  .median().sort_values(by=margin_column, ascending=False)).reset_index()
-    dff['median'] = dff.groupby(groupby)[margin_column].\
+    dff['median'] = dff.groupby(groupby, observed=True)[margin_column].\
             transform('median')
 
     dff = dff.sort_values(['median', margin_column],
@@ -524,12 +549,20 @@ def make_results_distribution(df,
                                                 dff[groupby_primary][index],
                                                 dff[groupby_secondary][index],
                                                dff[groupby_tertiary][index])
-            fig.add_trace(go.Violin(x=trace[margin_column],
-                              y=trace["Site"],
-                              name=name,
-                            side='positive'))
-    fig.update_traces(meanline_visible=True, orientation='h')
+            values = trace[margin_column]
+            if kde and np.isfinite(values).sum() > dist_cutoff:
+                fig.add_trace(kde_violin(values[np.isfinite(values)].values,
+                                         name, -len(fig.data)))
+            elif not kde:
+                fig.add_trace(go.Violin(x=values,
+                                  y=trace["Site"],
+                                  name=name,
+                                side='positive'))
+    fig.update_traces(meanline_visible=True, orientation='h',
+                      selector=dict(type='violin'))
     fig.update_xaxes(rangemode="nonnegative")
+    if kde:
+        fig.update_yaxes(showticklabels=False)
     fig.update_layout({
                 "title": '{}'.format(margin_column),
                 "xaxis.title": "{}".format(margin_column),
@@ -572,7 +605,9 @@ UPLOAD = html.Div([
                 'padding': '5px',
             },
             multiple=False
-        ),],className='four columns',
+        ),
+        html.P(id='upload-job-status',
+               style={'textAlign': 'center'}),],className='four columns',
             style={
             'margin-left': '40px',
             },
@@ -588,7 +623,8 @@ UPLOAD = html.Div([
         html.Div([
         dcc.Dropdown(id='preset-files',
                      multi=False,
-                     options=[{'label': i, 'value': i} for i in ['Cleveland Filtered', 'Cleveland', 'Oak Creek']],
+                     options=[{'label': i, 'value': i} for i in ['Cleveland Filtered', 'Cleveland', 'Oak Creek'] +
+                              ['Synthetic {}'.format(rows) for rows in synthetic_rows]],
                      # placeholder="Select Cloud Dataset",
                      className='dcc_control',
                      style={
@@ -642,10 +678,26 @@ UPLOAD = html.Div([
 HIDDEN = html.Div([
     html.Div(id='production-df-upload',
              style={'display': 'none'},
-             children=production_json),
+             children=production_id),
     # html.Div(id='stat-df-upload',
     #          style={'display': 'none'},
     #          children=stat_json),
+    html.Div(id='opportunity-job',
+             style={'display': 'none'}),
+    html.Div(id='upload-job',
+             style={'display': 'none'}),
+    html.Div(id='scan-job',
+             style={'display': 'none'}),
+    dcc.Store(id='scan-choice'),
+    dcc.Interval(id='upload-interval',
+                 interval=500,
+                 disabled=True),
+    dcc.Store(id='volume-column',
+              data=volume_column),
+    dcc.Store(id='relayout-pending'),
+    dcc.Store(id='secondary-relayout'),
+    dcc.Interval(id='relayout-debounce',
+                 interval=200),
     html.Div(id='descriptors-upload',
              style={'display': 'none'},
              children=descriptors),
@@ -767,12 +819,20 @@ VISUALIZATION = html.Div([
                            ['Scatter', 'Distribution', 'Parallel Coordinates (Time)']],
                  value='Distribution',
                  className="dcc_control"),
+    dcc.Checklist(id='violin-kde',
+                  options=[{'label': ' Server-side densities', 'value': 'kde'}],
+                  value=[],
+                  className="dcc_control"),
     html.P('Plot Metric'),
     dcc.Dropdown(id='data-type',
                  options=[{'label': i, 'value': i} for i in
                            ['Rate (Gal/Hr)', 'Volume (Gal)', 'Time (Hr)']],
                  value='Rate (Gal/Hr)',
                  className="dcc_control"),
+    dcc.Checklist(id='webgl',
+                  options=[{'label': ' WebGL timeline', 'value': 'webgl'}],
+                  value=[],
+                  className="dcc_control"),
       ],style={'max-height': '500px',
                'margin-top': '20px',
                'overflow': 'scroll'}
@@ -868,10 +928,29 @@ dcc.Dropdown(id='time_dropdown_analytics',
              value=time_components[1],
              multi=False,
              className="dcc_control"),
+html.P('Quantile Target'),
+dcc.Dropdown(id='quantile_dropdown_analytics',
+             options=[{'label': '{:.0%}'.format(i), 'value': i} for i in
+                       quant_targets],
+             value=0.75,
+             multi=False,
+             className="dcc_control"),
 html.Button('Find opportunity',
             id='opportunity-button',
             style={'textAlign': 'center',
                    'margin-bottom': '10px'}),
+html.Button('Scan all groupings',
+            id='scan-button',
+            style={'textAlign': 'center',
+                   'margin-bottom': '10px'}),
+html.P(id='opportunity-job-status'),
+dcc.Interval(id='opportunity-interval',
+             interval=500,
+             disabled=True),
+html.P(id='scan-job-status'),
+dcc.Interval(id='scan-interval',
+             interval=500,
+             disabled=True),
 html.P('Plot Metric'),
 dcc.Dropdown(id='data-type-analytics',
              options=[{'label': i, 'value': i} for i in
@@ -984,51 +1063,60 @@ app.config.suppress_callback_exceptions = True
 
 #### Tab control stuff
 ### UPLOAD TOOL ###
+# relayout events are debounced in the browser, see assets/debounce.js
+app.clientside_callback(
+    ClientsideFunction('debounce', 'stamp'),
+    Output('relayout-pending', 'data'),
+    [Input('secondary_plot', 'relayoutData')]
+)
+
+app.clientside_callback(
+    ClientsideFunction('debounce', 'settle'),
+    Output('secondary-relayout', 'data'),
+    [Input('relayout-debounce', 'n_intervals')],
+    [State('relayout-pending', 'data'),
+     State('secondary-relayout', 'data')]
+)
+
 @app.callback(
-    [Output('production-df-upload', 'children'),],
+    [Output('production-df-upload', 'children'),
+     Output('upload-job', 'children'),
+     Output('upload-interval', 'disabled'),
+     Output('upload-job-status', 'children')],
   [Input('upload-data', 'contents'),
-   Input('preset-files', 'value')],
+   Input('preset-files', 'value'),
+   Input('upload-interval', 'n_intervals')],
   [State('upload-data', 'filename'),
-   State('upload-data', 'last_modified')])
-def update_production_df_and_table(list_of_contents, preset_file, list_of_names, list_of_dates):
-    if list_of_contents is not None:
-        df = [parse_contents(c, n, d) for c, n, d in
-            zip(list_of_contents, list_of_names, list_of_dates)]
-        df = df[0]
-        columns = [{'label': i, 'value': i} for i in df.columns]
-        columns_table = [{"name": i, "id": i} for i in df.columns]
-        return columns, columns, df.to_json(), columns
+   State('upload-data', 'last_modified'),
+   State('upload-job', 'children')])
+def update_production_df_and_table(contents, preset_file, intervals, filename,
+                                   last_modified, job_id):
+    ctx = dash.callback_context
+    triggers = [i['prop_id'] for i in ctx.triggered]
+    if (contents is not None) and ('upload-data.contents' in triggers):
+        job_id = submit_job(ingest_upload, spool_upload(contents, filename),
+                            dates, time_components)
+    elif 'upload-interval.n_intervals' in triggers:
+        if job_id is None:
+            raise dash.exceptions.PreventUpdate
+    elif (preset_file is not None) and preset_file.startswith('Synthetic '):
+        job_id = submit_job(synthetic_preset, int(preset_file.split()[1]))
     elif preset_file is not None:
-
-        dates = ['Batch Completion Date', 'First Formulated Consumed Material', 'TO.80 Log Date']
         # if preset_file == 'Cleveland':
         #     production_df = whole_df
         # else:
-        production_df = pd.read_csv('data/{}.csv'.format(preset_file), parse_dates=dates)
-        descriptors = ['Batch Completion Date', 'Batch Number', 'Tank Number',
-               'Cost Center', 'Technology', 'Product', 'Inventory Category',
-               'Equalization Lot Number', 'Parent Batch Planned Qty',
-               'Parent Batch Actual Qty', 'Family']
-        time_components = ['PA Time',
-         'Tot. CM Time',
-         '80 appv.',
-         'Filling Time',
-         'Tot. Time']
-        time_components = production_df.columns[6:11]
-        for col in time_components:
-            production_df[col] = pd.to_timedelta(production_df[col])
-        time_column = time_components[-1]
-        volume_column = 'Parent Batch Actual Qty'
-        margin_column = "{} By {}".format(volume_column, time_column)
-        production_df[margin_column] = production_df[volume_column] /\
-            (production_df[time_components[-1]].dt.total_seconds()/60/60)
-        groupby_primary = 'Technology'
-        groupby_secondary = descriptors[2]
-        # df = pd.read_csv('data/{}.csv'.format(preset_file))
-        columns = [{'label': i, 'value': i} for i in production_df.columns]
-        columns_table = [{"name": i, "id": i} for i in production_df.columns]
-        print(production_df.head())
-        return [production_df.to_json()]
+        return [ingest_preset('data/{}.csv'.format(preset_file),
+                              dates, time_components), None, True, '']
+    else:
+        raise dash.exceptions.PreventUpdate
+
+    status = job_status(job_id)
+    if status['state'] == 'error':
+        return [dash.no_update, None, True, 'Upload failed: {}'.format(status['error'])]
+    if status['state'] != 'done':
+        return [dash.no_update, job_id, False,
+                'Uploading... {:.0%}'.format(status['progress'])]
+    return [job_result(job_id), None, True, '']
 
 # @app.callback(
 #     [Output('production-df-upload', 'children'),
@@ -1061,65 +1149,117 @@ def update_production_df_and_table(list_of_contents, preset_file, list_of_names,
 #                                                   ascending=False)
 #         return production_df.to_json()
 
+@app.callback(
+    [Output('primary_dropdown_analytics', 'value'),
+    Output('secondary_dropdown_analytics', 'value'),
+    Output('tertiary_dropdown_analytics', 'value'),
+    Output('scan-choice', 'data'),
+    Output('scan-job', 'children'),
+    Output('scan-interval', 'disabled'),
+    Output('scan-job-status', 'children')],
+    [Input('scan-button', 'n_clicks'),
+    Input('scan-interval', 'n_intervals')],
+    [State('production-df-upload', 'children'),
+    State('time_dropdown_analytics', 'value'),
+    State('quantile_dropdown_analytics', 'value'),
+    State('scan-job', 'children')]
+)
+def scan_opportunity_groupings(button, intervals, production_df, time,
+                               quant_target, job_id):
+    ctx = dash.callback_context
+    triggers = [i['prop_id'] for i in ctx.triggered]
+
+    if (button is not None) and ('scan-button.n_clicks' in triggers):
+        job_id = submit_job(scan_opportunities, production_df, descriptors,
+                            time_components, volume_column, quant_targets)
+    elif job_id is None:
+        raise dash.exceptions.PreventUpdate
+
+    status = job_status(job_id)
+    if status['state'] == 'error':
+        return [dash.no_update] * 4 + [None, True, 'Scan failed: {}'.format(status['error'])]
+    if status['state'] != 'done':
+        return [dash.no_update] * 4 + [job_id, False,
+                'Scanning... {:.0%}'.format(status['progress'])]
+
+    ranked = job_result(job_id)
+    ranked = ranked.loc[(ranked['Time Column'] == time) &
+                        np.isclose(ranked['Quantile Target'], quant_target)]
+    if ranked.shape[0] == 0:
+        return [dash.no_update] * 4 + [None, True, 'No opportunity found']
+    best = ranked.iloc[0]
+    groupby = [best['Primary'], best['Secondary'], best['Tertiary']]
+    return groupby + [{'groupby': groupby, 'time': time,
+                       'quant_target': quant_target}, None, True, '']
+
 @app.callback(
     [Output('opportunity-table', 'data'),
     Output('opportunity-table', 'columns'),
     Output('opportunity-table', 'filter_action'),
-    Output('opportunity-table', 'selected_rows')],
+    Output('opportunity-table', 'selected_rows'),
+    Output('opportunity-job', 'children'),
+    Output('opportunity-interval', 'disabled'),
+    Output('opportunity-job-status', 'children')],
     [Input('opportunity-button', 'n_clicks'),
+    Input('scan-choice', 'data'),
+    Input('opportunity-interval', 'n_intervals'),
     Input('production-df-upload', 'children'),
     Input('primary_dropdown_analytics', 'value'),
     Input('secondary_dropdown_analytics', 'value'),
     Input('tertiary_dropdown_analytics', 'value'),
     Input('time_dropdown_analytics', 'value'),
-    Input('tabs-control', 'value'),]
+    Input('quantile_dropdown_analytics', 'value'),
+    Input('tabs-control', 'value'),],
+    [State('opportunity-job', 'children')]
 )
-def display_opportunity_results(button, production_df, one, two, three, time, tab):
+def display_opportunity_results(button, choice, intervals, production_df, one,
+                                two, three, time, quant_target, tab, job_id):
     ctx = dash.callback_context
-
-    if (ctx.triggered[0]['prop_id'] == 'opportunity-button.n_clicks') or\
-       (ctx.triggered[0]['prop_id'] == 'tabs-control.value'):
-        production_df = pd.read_json(production_df)
-        for col in time_components:
-            production_df[col] = pd.to_timedelta(production_df[col], unit='ms')
-            production_df[col] = production_df[col].dt.total_seconds()/60/60
-        results = find_opportunity(production_df, one, two, three, time).reset_index()
-        results.columns = [str(x).strip().replace('(', '').replace(')', '').replace("'", '') for x in results.columns]
-        results = np.round(results)
-        results = results[[i for i in results.columns if ('75%' not in i) and ('50%' not in i)]]
-        metric = results['Time Opportunity, Hours']
-        results['Rating'] = results['Time Opportunity, Hours'].apply(lambda x:
-            '⭐⭐⭐⭐' if x > metric.quantile(0.99) else (
-            '⭐⭐⭐' if x > metric.quantile(0.75) else (
-            '⭐⭐' if x > metric.quantile(0.5) else (
-            '⭐' if x > metric.quantile(0.25) else ''
-        ))))
-        columns=[{"name": i, "id": i} for i in results.columns]
-        data = results.to_dict('rows')
-        rows = [i for i in results.index if results['Time Opportunity, Hours'][i] > metric.quantile(0.99)]
-
-        return data, columns, 'native', rows
-
-
-@app.callback(
+    triggers = [i['prop_id'] for i in ctx.triggered]
+
+    if (choice is not None) and ('scan-choice.data' in triggers):
+        # the dropdowns are set in the same step, their values here are stale
+        (one, two, three), time, quant_target = choice['groupby'],\
+            choice['time'], choice['quant_target']
+    if ('opportunity-button.n_clicks' in triggers) or\
+       ('scan-choice.data' in triggers) or\
+       ('tabs-control.value' in triggers):
+        job_id = submit_job(opportunity_table, production_df, descriptors,
+                            time_components, volume_column,
+                            [one, two, three], time, quant_target)
+    elif ('opportunity-interval.n_intervals' not in triggers) or (job_id is None):
+        raise dash.exceptions.PreventUpdate
+
+    status = job_status(job_id)
+    if status['state'] == 'error':
+        return [dash.no_update] * 4 + [None, True, 'Failed: {}'.format(status['error'])]
+    if status['state'] != 'done':
+        return [dash.no_update] * 4 + [job_id, False,
+                'Computing... {:.0%}'.format(status['progress'])]
+
+    results = job_result(job_id).reset_index()
+    results.columns = [str(x).strip().replace('(', '').replace(')', '').replace("'", '') for x in results.columns]
+    results = np.round(results)
+    target = '{:.0%}'.format(quant_target)
+    results = results[[i for i in results.columns if (target not in i) and ('50%' not in i)]]
+    metric = results['Time Opportunity, Hours']
+    cuts = metric.quantile([0.25, 0.5, 0.75, 0.99]).values
+    results['Rating'] = np.select([metric > cuts[3], metric > cuts[2],
+                                   metric > cuts[1], metric > cuts[0]],
+                                  ['⭐⭐⭐⭐', '⭐⭐⭐', '⭐⭐', '⭐'], '')
+    columns=[{"name": i, "id": i} for i in results.columns]
+    data = results.to_dict('rows')
+    rows = list(results.index[metric > cuts[3]])
+
+    return data, columns, 'native', rows, None, True, ''
+
+
+app.clientside_callback(
+    ClientsideFunction('clientside', 'tab_styles'),
     [Output('secondary_plot', 'style'),
      Output('opportunity-table-block', 'style'),],
     [Input('tabs-control', 'value'),]
 )
-def display_violin_plot(tab):
-    if (tab == 'tab-1') | (tab == 'tab-3') | (tab == 'tab-4'):
-            return {'display': 'block',
-             'margin': '10px',
-             'padding': '15px',
-             'position': 'relative',
-             'border-radius': '5px',
-             'width': '95%'}, {'display': 'none'}
-    elif tab == 'tab-2':
-            return {'display': 'none'}, \
-            {'max-height': '500px',
-               'overflow': 'scroll',
-               'display': 'block',
-               'padding': '0px 20px 20px 20px'}
 
 @app.callback(
     [Output('kpi-1', 'children'),
@@ -1136,7 +1276,7 @@ def display_violin_plot(tab):
     Input('secondary_dropdown', 'value'),
     Input('secondary_plot', 'clickData'),
     Input('primary_plot', 'selectedData'),
-    Input('secondary_plot', 'relayoutData'),
+    Input('secondary-relayout', 'data'),
     Input('time_dropdown', 'value'),
     Input('time_dropdown_analytics', 'value'),
     ]
@@ -1144,9 +1284,10 @@ def display_violin_plot(tab):
 def display_opportunity(filter_category, filter_selected, rows, data, tab,
                         production_df, margin_column, groupby_primary,
                         groupby_secondary, clickData, selectedData,
-                        relayoutData, time_column, time):
+                        relayout, time_column, time):
+    relayoutData = relayout['data'] if relayout else None
     if (tab == 'tab-2') and (data is not None) and (len(rows) > 0):
-        production_df = pd.read_json(production_df, convert_dates=dates)
+        production_df = decode_dataset(production_df)
 #         total_volume = pd.DataFrame(data)['Parent Batch Actual Qty, sum'].sum()/1e6
         total_volume = production_df['Parent Batch Actual Qty'].sum()/1e6
         extra_volume = pd.DataFrame(data).iloc[rows]['Volume Opportunity, Gal'].sum()/1e6
@@ -1168,24 +1309,12 @@ def display_opportunity(filter_category, filter_selected, rows, data, tab,
         return "{:.1f} M Gal / Hr".format(new_rate), \
         "+ {:.0f} Batches ({:.2f}%)".format(extra_batches, batch_increase), \
         "+ {:.2f} M Gal ({:.2f}%)".format(extra_volume, volume_increase)
-    if type(filter_selected) == str:
-        filter_selected = [filter_selected]
-    production_df = pd.read_json(production_df, convert_dates=dates)
-    production_df = production_df.loc[production_df[filter_category].isin(
-        filter_selected)]
-    for col in time_components:
-        production_df[col] = pd.to_timedelta(production_df[col], unit='ms')
-    production_df[margin_column] = production_df[volume_column] /\
-        (production_df[time_column].dt.total_seconds()/60/60)
-    # production_df = production_df.loc[production_df[margin_column] < np.inf]
-    production_df = production_df.loc[(production_df[margin_column] <
-        production_df[margin_column].quantile(0.995))]
-    if relayoutData is not None:
-        if 'xaxis.range[0]' in relayoutData.keys():
-            start = pd.to_datetime(relayoutData['xaxis.range[0]'])
-            end = pd.to_datetime(relayoutData['xaxis.range[1]'])
-            production_df = production_df.loc[(production_df[dates[-1]] < end) &
-                                              (production_df[dates[-1]] > start)]
+    if not claim_request(relayout, 'kpi'):
+        raise dash.exceptions.PreventUpdate
+    production_df = view_dataset(production_df, filter_category,
+        filter_selected, time_column, relayout_range(relayoutData),
+        volume_column)
+    margin_column = "{} By {}".format(volume_column, time_column)
     old_kpi_2 = production_df.shape[0]
     old_kpi_1 = production_df[margin_column].mean()
     old_kpi_3 = production_df[volume_column].sum()
@@ -1205,7 +1334,7 @@ def display_opportunity(filter_category, filter_selected, rows, data, tab,
      Input('production-df-upload', 'children'),]
 )
 def update_filter(category, type, production_df):
-    production_df = pd.read_json(production_df)
+    production_df = decode_dataset(production_df)
     if type == 'Distribution':
         if len(production_df[category].unique()) > 1:
             return [{'label': i, 'value': i} for i in production_df[category].unique()],\
@@ -1227,29 +1356,23 @@ def update_filter(category, type, production_df):
 #     else:
 #         return True
 
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction('clientside', 'margin_column'),
     Output('margin-upload', 'children'),
     [Input('time_dropdown', 'value'),
     Input('time_dropdown_analytics', 'value'),
-    Input('tabs-control', 'value'),]
+    Input('tabs-control', 'value'),],
+    [State('volume-column', 'data')]
 )
-def margin_column(time_column, time, tab):
-    if tab == 'tab-2':
-        return "{} By {}".format(volume_column, time)
-    else:
-        return "{} By {}".format(volume_column, time_column)
 
-@app.callback(
+app.clientside_callback(
+    ClientsideFunction('clientside', 'margin_column'),
     Output('margin-label', 'children'),
     [Input('time_dropdown', 'value'),
     Input('time_dropdown_analytics', 'value'),
-    Input('tabs-control', 'value'),]
+    Input('tabs-control', 'value'),],
+    [State('volume-column', 'data')]
 )
-def margin_column(time_column, time, tab):
-    if tab == 'tab-2':
-        return "{} By {}".format(volume_column, time)
-    else:
-        return "{} By {}".format(volume_column, time_column)
 
 ### FIGURES ###
 @app.callback(
@@ -1263,7 +1386,7 @@ def margin_column(time_column, time, tab):
     Input('margin-upload', 'children'),
     Input('primary_dropdown', 'value'),
     Input('secondary_dropdown', 'value'),
-    Input('secondary_plot', 'relayoutData'),
+    Input('secondary-relayout', 'data'),
     Input('time_dropdown', 'value'),
     Input('distribution', 'value'),
     Input('data-type', 'value'),
@@ -1272,21 +1395,42 @@ def margin_column(time_column, time, tab):
     Input('tertiary_dropdown_analytics', 'value'),
     Input('time_dropdown_analytics', 'value'),
     Input('data-type-analytics', 'value'),
+    Input('violin-kde', 'value'),
     ]
 )
 def display_primary_plot(filter_category, filter_selected, rows, data, tab,
                         production_df, margin_column, groupby_primary,
-                        groupby_secondary, relayoutData, time_column,
+                        groupby_secondary, relayout, time_column,
                         chart_type, data_type, one, two, three, time,
-                        data_type_analytics):
-    production_df = pd.read_json(production_df, convert_dates=dates)
+                        data_type_analytics, kde):
+    kde = 'kde' in (kde or [])
+    relayoutData = relayout['data'] if relayout else None
+    if not claim_request(relayout, 'primary_plot'):
+        raise dash.exceptions.PreventUpdate
+    if (tab == 'tab-2') and (data is not None) and (len(rows) > 0):
+        view = [one, two, three, time, data_type_analytics, kde,
+                [[data[row][i] for i in [one, two, three]] for row in rows]]
+    else:
+        view = [filter_category, filter_selected, groupby_primary,
+                groupby_secondary, relayout_range(relayoutData), time_column,
+                chart_type, data_type, kde]
+    return cached_figure('primary_plot', production_df, view,
+        lambda: primary_plot(filter_category, filter_selected, rows, data,
+                             tab, production_df, margin_column,
+                             groupby_primary, groupby_secondary, relayoutData,
+                             time_column, chart_type, data_type, one, two,
+                             three, time, data_type_analytics, kde, relayout))
+
+def primary_plot(filter_category, filter_selected, rows, data, tab,
+                 production_df, margin_column, groupby_primary,
+                 groupby_secondary, relayoutData, time_column, chart_type,
+                 data_type, one, two, three, time, data_type_analytics, kde,
+                 request=None):
+    key = production_df
     margin_column = "{} By {}".format(volume_column, time_column)
-    for col in time_components:
-        production_df[col] = pd.to_timedelta(production_df[col], unit='ms')
-    production_df[margin_column] = production_df[volume_column] /\
-        (production_df[time_column].dt.total_seconds()/60/60)
 
     if (tab == 'tab-2') and (data is not None) and (len(rows) > 0):
+        production_df = decode_dataset(key)
         # for col in time_components:
         #     production_df[col] = pd.to_timedelta(production_df[col], unit='ms')
         groupby_primary = one
@@ -1305,34 +1449,18 @@ def display_primary_plot(filter_category, filter_selected, rows, data, tab,
                               (production_df[groupby_tertiary] == group_three)]])
 
         return make_results_distribution(sub_df, one, two, three, time,
-            data_type_analytics)
+            data_type_analytics, kde=kde)
     # elif (tab == 'tab-2'):
     #     return None
-    if type(filter_selected) == str:
-        filter_selected = [filter_selected]
-
-    production_df = production_df.loc[production_df[filter_category].isin(
-        filter_selected)]
-    production_df = production_df.loc[production_df[margin_column] < np.inf]
-    production_df = production_df.loc[(production_df[margin_column] <
-        production_df[margin_column].quantile(0.997))]
-    print('prim filt ', production_df.shape)
-
-    if relayoutData is not None:
-        if 'xaxis.range[0]' in relayoutData.keys():
-            start = pd.to_datetime(relayoutData['xaxis.range[0]'])
-            end = pd.to_datetime(relayoutData['xaxis.range[1]'])
-            production_df = production_df.loc[(production_df[dates[-1]] < end) &
-                                              (production_df[dates[-1]] > start)]
-        return make_primary_plot(production_df,
-          margin_column, volume_column, groupby_primary,
-          groupby_secondary, time_column, chart_type=chart_type,
-          data_type=data_type)
+    production_df = view_dataset(key, filter_category, filter_selected,
+        time_column, relayout_range(relayoutData), volume_column)
+    if superseded(request, 'primary_plot'):
+        raise dash.exceptions.PreventUpdate
 
     return make_primary_plot(production_df,
       margin_column, volume_column, groupby_primary,
       groupby_secondary, time_column, chart_type=chart_type,
-      data_type=data_type)
+      data_type=data_type, kde=kde)
 
 @app.callback(
     Output('secondary_plot', 'figure'),
@@ -1348,29 +1476,45 @@ def display_primary_plot(filter_category, filter_selected, rows, data, tab,
     Input('time_dropdown', 'value'),
     Input('distribution', 'value'),
     Input('data-type', 'value'),
+    Input('webgl', 'value'),
+    Input('secondary-relayout', 'data'),
     ]
 )
 def display_secondary_plot(filter_category, filter_selected, rows, data, tab,
                         production_df, margin_column, groupby_primary,
-                        groupby_secondary, time_column, chart_type, data_type):
-    production_df = pd.read_json(production_df, convert_dates=dates)
+                        groupby_secondary, time_column, chart_type, data_type,
+                        webgl, relayout):
+    ctx = dash.callback_context
+    relayoutData = relayout['data'] if relayout else None
+    if [i['prop_id'] for i in ctx.triggered] == ['secondary-relayout.data']:
+        # only the downsampled scatter is re-queried on zoom
+        if (chart_type == 'Distribution') or (relayoutData is None) or\
+           not any(i.startswith('xaxis.range') or i == 'xaxis.autorange'
+                   for i in relayoutData):
+            raise dash.exceptions.PreventUpdate
+    if not claim_request(relayout, 'secondary_plot'):
+        raise dash.exceptions.PreventUpdate
+    webgl = 'webgl' in (webgl or [])
+    x_range = relayout_range(relayoutData) if chart_type != 'Distribution' else None
+    view = [filter_category, filter_selected, groupby_primary,
+            groupby_secondary, time_column, chart_type, data_type, webgl,
+            x_range]
+    return cached_figure('secondary_plot', production_df, view,
+        lambda: secondary_plot(filter_category, filter_selected,
+                               production_df, groupby_primary,
+                               groupby_secondary, time_column, chart_type,
+                               data_type, webgl, x_range))
+
+def secondary_plot(filter_category, filter_selected, production_df,
+                   groupby_primary, groupby_secondary, time_column,
+                   chart_type, data_type, webgl, x_range):
     margin_column = "{} By {}".format(volume_column, time_column)
-    if type(filter_selected) == str:
-        filter_selected = [filter_selected]
-
-    production_df = production_df.loc[production_df[filter_category].isin(
-        filter_selected)]
-    for col in time_components:
-        production_df[col] = pd.to_timedelta(production_df[col], unit='ms')
-    production_df[margin_column] = production_df[volume_column] /\
-        (production_df[time_column].dt.total_seconds()/60/60)
-    production_df = production_df.loc[production_df[margin_column] < np.inf]
-    production_df = production_df.loc[(production_df[margin_column] <
-        production_df[margin_column].quantile(0.997))]
-    print('secon filt ', production_df.shape)
+    production_df = view_dataset(production_df, filter_category,
+        filter_selected, time_column, volume_column=volume_column)
     return make_secondary_plot(production_df,
         margin_column, time_column, groupby_primary,
-        groupby_secondary, chart_type=chart_type, data_type=data_type)
+        groupby_secondary, chart_type=chart_type, data_type=data_type,
+        webgl=webgl, x_range=x_range)
 
 # @app.callback(
 #     Output('tertiary_plot', 'figure'),
@@ -1425,4 +1569,6 @@ def display_secondary_plot(filter_category, filter_selected, rows, data, tab,
 #         clickData=clickData, toAdd=toAdd, col=col, val=val)
 
 if __name__ == "__main__":
+    for output in audit_callbacks(app):
+        print('server callback does not touch data, consider clientside: {}'.format(output))
     app.run_server(debug=True)
@@ -0,0 +1,21 @@
+if (!window.dash_clientside) {
+  window.dash_clientside = {};
+}
+window.dash_clientside.debounce = {
+  // stamp every relayout event with the time and this tab's session
+  stamp: function(relayoutData) {
+    if (!window.ppg_session) {
+      window.ppg_session = Math.random().toString(36).slice(2);
+    }
+    return {data: relayoutData, time: Date.now(), session: window.ppg_session};
+  },
+  // pass the latest event on once the view has been still for `wait` ms
+  settle: function(n_intervals, pending, settled) {
+    var wait = 300;
+    if (!pending || (Date.now() - pending.time < wait) ||
+        (settled && settled.time === pending.time)) {
+      throw window.dash_clientside.PreventUpdate;
+    }
+    return pending;
+  }
+};
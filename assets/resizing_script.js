@@ -9,5 +9,25 @@ window.dash_clientside.clientside = {
       console.log("fired resize");
     }, 500);
     return null;
+  },
+  // secondary plot and opportunity table visibility per tab
+  tab_styles: function(tab) {
+    if (tab === 'tab-2') {
+      return [{'display': 'none'},
+              {'max-height': '500px',
+               'overflow': 'scroll',
+               'display': 'block',
+               'padding': '0px 20px 20px 20px'}];
+    }
+    return [{'display': 'block',
+             'margin': '10px',
+             'padding': '15px',
+             'position': 'relative',
+             'border-radius': '5px',
+             'width': '95%'}, {'display': 'none'}];
+  },
+  // rate column label for the time column of the active tab
+  margin_column: function(time_column, time, tab, volume_column) {
+    return volume_column + ' By ' + (tab === 'tab-2' ? time : time_column);
   }
 };
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+timings for the data paths behind the dashboard callbacks
+
+usage: python benchmarks.py [name ...]
+"""
+import itertools
+import sys
+import timeit
+
+import pandas as pd
+import numpy as np
+import plotly.graph_objects as go
+from scipy import stats
+from utils import *
+
+dates = ['Batch Completion Date', 'First Formulated Consumed Material', 'TO.80 Log Date']
+time_components = ['PA Time',
+ 'Tot. CM Time',
+ '80 appv.',
+ 'Filling Time',
+ 'Tot. Time']
+descriptors = ['Family', 'Tank Number',
+       'Cost Center', 'Technology', 'Product', 'Parent Batch Actual Qty', 'Site']
+volume_column = 'Parent Batch Actual Qty'
+
+def load(path):
+    return get_dataset(ingest_preset(path, dates, time_components))
+
+def best_of(func, repeat=5, number=1):
+    """
+    best wall time of func in seconds
+    """
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+def report(name, baseline, optimized):
+    print('{:<40} {:>10.3f} ms {:>10.3f} ms {:>8.1f}x'.format(
+        name, baseline * 1e3, optimized * 1e3, baseline / optimized))
+
+def bench_parse_timedelta(path='data/Oak Creek.csv'):
+    raw = pd.read_csv(path, usecols=time_components)
+    # rows off the fixed format go through pd.to_timedelta and must agree
+    mixed = pd.Series(['1 days 00:00:01', '-1 days +23:00:00', '0 days 01:02:03.250000000',
+                       '2 days 03:04:05', '00:30:00', None, '12 days 00:00:00.000000001'])
+    assert parse_timedelta(mixed).equals(pd.to_timedelta(mixed).astype('m8[ns]'))
+    for col in time_components:
+        report('parse_timedelta {}'.format(col),
+               best_of(lambda: pd.to_timedelta(raw[col])),
+               best_of(lambda: parse_timedelta(raw[col])))
+
+def opportunity_groupby(df, groupby, time_column):
+    """
+    the three separate groupbys the opportunity table was built from before
+    """
+    margin_column = "{} By {}".format(volume_column, time_column)
+    desc = df.groupby(groupby, observed=True)[margin_column].describe()[['50%', '75%']]
+    totals = df.groupby(groupby, observed=True)[[volume_column, time_column]].agg(['sum', 'std', 'mean'])
+    count = df.groupby(groupby, observed=True)[volume_column].agg(['count'])
+    return desc.join(totals).dropna().join(count)
+
+def opportunity_single_pass(df, groupby, time_column):
+    margin_column = "{} By {}".format(volume_column, time_column)
+    return aggregate_groups(df, groupby, [
+        (margin_column, 0.5), (margin_column, 0.75),
+        (volume_column, 'sum'), (volume_column, 'std'), (volume_column, 'mean'),
+        (time_column, 'sum'), (time_column, 'std'), (time_column, 'mean'),
+        (volume_column, 'count')]).dropna()
+
+def bench_opportunity(path='data/Oak Creek.csv', time_column='Tot. Time', repeat=1):
+    """
+    the opportunity table of every descriptor triple, from a StatsCube cell
+    computed on first use as opportunity_table does, and from one
+    aggregate_groups pass as the scan does per triple
+
+    The baseline takes minutes per run, so every path is timed `repeat`
+    times.
+    """
+    key = ingest_preset(path, dates, time_components)
+    df = load(path)
+    df[time_column] = df[time_column].dt.total_seconds()/60/60
+    df["{} By {}".format(volume_column, time_column)] = df[volume_column] / df[time_column]
+    combos = list(itertools.combinations(descriptors, 3))
+    baseline = single_pass = cube = 0
+    for groupby in combos:
+        baseline += best_of(lambda: opportunity_groupby(df, list(groupby), time_column), repeat)
+        single_pass += best_of(lambda: opportunity_single_pass(df, list(groupby), time_column), repeat)
+        cube += best_of(lambda: StatsCube(decode_dataset(key), descriptors, time_components,
+                                          volume_column).opportunity(list(groupby), time_column), repeat)
+    report('opportunity table {} triples'.format(len(combos)), baseline, cube)
+    report('scan aggregation {} triples'.format(len(combos)), baseline, single_pass)
+
+def violin_traces_masked(df, groupby, margin_column, dff):
+    """
+    the per-group boolean masks make_primary_plot used for its violins
+    """
+    traces = []
+    for index in dff.index:
+        mask = np.ones(df.shape[0], dtype=bool)
+        for col in groupby:
+            mask &= df[col] == dff[col][index]
+        traces.append(df.loc[mask, margin_column].values)
+    return traces
+
+def violin_traces_indexed(df, groupby, margin_column, dff):
+    indices = df.groupby(groupby, observed=True).indices
+    margin = df[margin_column].values
+    return [margin[indices[tuple(row) if len(groupby) > 1 else row[0]]]
+            for row in dff[groupby].itertuples(index=False)]
+
+def bench_violin_traces(path='data/Oak Creek.csv', time_column='Tot. Time'):
+    df = load(path)
+    margin_column = "{} By {}".format(volume_column, time_column)
+    df[margin_column] = df[volume_column] / (df[time_column].dt.total_seconds()/60/60)
+    for groupby in [['Product'], ['Product', 'Tank Number']]:
+        dff = df.groupby(groupby, observed=True)[margin_column].median().reset_index()
+        report('violin traces {}'.format(' x '.join(groupby)),
+               best_of(lambda: violin_traces_masked(df, groupby, margin_column, dff)),
+               best_of(lambda: violin_traces_indexed(df, groupby, margin_column, dff)))
+
+def timeline_per_batch(df, column, margin_column, start_date, end_date):
+    """
+    the two-point trace per batch make_secondary_plot drew before
+    """
+    fig = go.Figure()
+    for name, group in df.groupby(column, observed=True):
+        for x1, x2, y in zip(group[start_date], group[end_date], group[margin_column]):
+            fig.add_trace(go.Scatter(x=[x1, x2], y=[y, y], name=str(name),
+                                     mode='lines+markers'))
+    return fig
+
+def timeline_segments(df, column, margin_column, start_date, end_date):
+    fig = go.Figure()
+    start = df[start_date].values
+    end = df[end_date].values
+    margin = df[margin_column].values
+    for name, index in df.groupby(column, observed=True).indices.items():
+        x, y = segment_arrays(start[index], end[index], margin[index])
+        fig.add_trace(go.Scatter(x=x, y=y, name=str(name), mode='lines+markers'))
+    return fig
+
+def bench_timeline(path='data/test.csv', time_column='Tot. Time'):
+    df = load(path)
+    margin_column = "{} By {}".format(volume_column, time_column)
+    df[margin_column] = df[volume_column] / (df[time_column].dt.total_seconds()/60/60)
+    for column in ['Family', 'Product']:
+        args = (df, column, margin_column, dates[1], dates[2])
+        report('timeline by {} build'.format(column),
+               best_of(lambda: timeline_per_batch(*args)),
+               best_of(lambda: timeline_segments(*args)))
+        print('{:<40} {:>10} kB {:>10} kB'.format('timeline by {} payload'.format(column),
+              len(timeline_per_batch(*args).to_json()) // 1024,
+              len(timeline_segments(*args).to_json()) // 1024))
+
+def bench_filter_index(path='data/Oak Creek.csv'):
+    key = ingest_preset(path, dates, time_components)
+    df = decode_dataset(key)
+    for column in ['Family', 'Tank Number', 'Product']:
+        values = list(df[column].dropna().unique())
+        index = inverted_index(key, column)
+        for label, selected in [('one', values[:1]), ('all', values)]:
+            report('filter {} {}'.format(column, label),
+                   best_of(lambda: np.nonzero(df[column].isin(selected).values)[0], number=20),
+                   best_of(lambda: index.rows(selected), number=20))
+
+def bench_date_window(path='data/Oak Creek.csv', column='TO.80 Log Date'):
+    key = ingest_preset(path, dates, time_components)
+    df = decode_dataset(key)
+    index = date_index(key, column)
+    for days in [7, 90]:
+        start = df[column].min() + pd.Timedelta(days=180)
+        end = start + pd.Timedelta(days=days)
+        report('date window {} days'.format(days),
+               best_of(lambda: np.nonzero(((df[column] < end) & (df[column] > start)).values)[0], number=20),
+               best_of(lambda: np.sort(index.window(start, end)), number=20))
+
+def median_test_loop(df, metric, descriptors):
+    """
+    the scipy median_test per group my_median_test ran before
+    """
+    moods = []
+    for descriptor in descriptors:
+        for item in df[descriptor].unique():
+            try:
+                stat, p, m, table = stats.median_test(df.loc[df[descriptor] == item][metric],
+                                       df.loc[~(df[descriptor] == item)][metric], nan_policy='omit')
+                moods.append([descriptor, item, stat, p, m, table])
+            except:
+                pass
+    return moods
+
+def bench_median_test(path='data/Oak Creek.csv', time_column='Tot. Time'):
+    df = load(path)
+    metric = "{} By {}".format(volume_column, time_column)
+    df[metric] = df[volume_column] / (df[time_column].dt.total_seconds()/60/60)
+    df.loc[np.isinf(df[metric]), metric] = np.nan
+    columns = [col for col in descriptors if col != volume_column]
+    stat_df = my_median_test(df, metric, columns, stat_cut_off=1)
+    loop = pd.DataFrame(median_test_loop(df, metric, columns),
+                        columns=['descriptor', 'group', 'stat', 'p', 'm', 'table'])
+    loop = loop.sort_values(by='stat', ascending=False)
+    loop = loop.loc[loop['p'] < 1].drop_duplicates('stat')
+    assert np.allclose(loop['stat'].values, stat_df.sort_values(by='stat', ascending=False)['stat'].values)
+    report('median_test {} groups'.format(loop.shape[0]),
+           best_of(lambda: median_test_loop(df, metric, columns)),
+           best_of(lambda: my_median_test(df, metric, columns, stat_cut_off=1)))
+
+def correlation_loop(df, metric, columns):
+    """
+    one scipy pearsonr per descriptor on the rows where both are present
+    """
+    y = df[metric].values
+    results = []
+    for col in columns:
+        x = df[col].values
+        mask = ~np.isnan(x) & ~np.isnan(y)
+        results.append(stats.pearsonr(x[mask], y[mask]))
+    return results
+
+def bench_correlation(path='data/Oak Creek.csv', time_column='Tot. Time', width=48):
+    df = load(path)
+    metric = "{} By {}".format(volume_column, time_column)
+    df[metric] = df[volume_column] / (df[time_column].dt.total_seconds()/60/60)
+    df.loc[np.isinf(df[metric]), metric] = np.nan
+    # stand-in process variables, noisy copies of the metric with gaps
+    state = np.random.RandomState(0)
+    columns = ['variable {}'.format(i) for i in range(width)]
+    for col in columns:
+        df[col] = df[metric] + state.normal(0, df[metric].std(), df.shape[0])
+        df.loc[state.random_sample(df.shape[0]) < 0.1, col] = np.nan
+    stat, p = correlate(df, metric, columns)
+    assert np.allclose(stat, [r for r, _ in correlation_loop(df, metric, columns)])
+    report('correlation {} columns'.format(width),
+           best_of(lambda: correlation_loop(df, metric, columns)),
+           best_of(lambda: correlate(df, metric, columns)))
+
+BENCHMARKS = {
+    'parse_timedelta': bench_parse_timedelta,
+    'opportunity': bench_opportunity,
+    'violin_traces': bench_violin_traces,
+    'timeline': bench_timeline,
+    'filter_index': bench_filter_index,
+    'date_window': bench_date_window,
+    'median_test': bench_median_test,
+    'correlation': bench_correlation,
+}
+
+if __name__ == "__main__":
+    print('{:<40} {:>13} {:>13} {:>9}'.format('benchmark', 'before', 'after', 'speedup'))
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
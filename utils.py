@@ -1,8 +1,43 @@
+import base64
+import concurrent.futures
+import hashlib
+import io
+import itertools
+import json
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
 import pandas as pd
 import numpy as np
 from scipy import stats
 import datetime
-import random
+
+DATASET_DIR = os.environ.get('PPG_DATASET_DIR', 'cache')
+DATASET_CACHE_BYTES = int(os.environ.get('PPG_DATASET_CACHE_MB', 512)) * 2**20
+_DATASETS = OrderedDict()
+_CUBES = OrderedDict()
+_INDEXES = OrderedDict()
+_VIEWS = OrderedDict()
+_FIGURES = OrderedDict()
+_CACHES = {'datasets': _DATASETS, 'cubes': _CUBES, 'indexes': _INDEXES,
+           'views': _VIEWS, 'figures': _FIGURES}
+# private bytes of every cached entry, least recently used first
+_CACHE_BYTES = OrderedDict()
+_DATASET_LOCK = threading.Lock()
+FIGURE_CACHE_SIZE = int(os.environ.get('PPG_FIGURE_CACHE_SIZE', 64))
+_FIGURE_STATS = {'hits': 0, 'misses': 0}
+JOB_WORKERS = int(os.environ.get('PPG_JOB_WORKERS', 2))
+JOB_TIMEOUT = float(os.environ.get('PPG_JOB_TIMEOUT', 900))
+JOB_HISTORY = int(os.environ.get('PPG_JOB_HISTORY', 64))
+_JOB_POOL = None
+REQUEST_TTL = float(os.environ.get('PPG_REQUEST_TTL', 3600))
+_REQUESTS_EXPIRED = 0.
 
 def convert_datatypes(df):
     """
@@ -27,94 +62,215 @@ def generate_product(df, descriptors, desc_columns=[2,8]):
     df['Product'] = df[descriptors[desc_columns[0]:desc_columns[1]]].agg('-'.join, axis=1)
     return df
 
-def generate_shift_data(df):
+def generate_shift_data(df, seed=None):
     """
-    generate shift data if there are none
+    generate shift data if there are none, low yield batches go to shift A,
+    slow ones to shift B and the rest at random
     """
     df = df.reset_index()
-    shift = []
-    for i in range(df.shape[0]):
-        if df['Yield'][i] < 0.6:
-            shift.append('A')
-        elif df['Rate'][i] < 400:
-            shift.append('B')
-        else:
-            shift.append(random.choice(['A', 'B', 'C']))
-    df['Shift'] = shift
+    shift = np.array(['A', 'B', 'C'])[np.random.RandomState(seed).randint(3, size=df.shape[0])]
+    shift = np.where(df['Rate'].values < 400, 'B', shift)
+    df['Shift'] = np.where(df['Yield'].values < 0.6, 'A', shift)
     return df
 
-def opportunity_conversion_days(x, annual_operating, metric='Rate', basis='Net Quantity Produced', line='E26'):
-    target = x.reorder_levels([1,0]).sort_index()#[0.9]
-    median = x.reorder_levels([1,0]).sort_index()[0.5]
-    if metric == 'Rate':
-        basis = 'Net Quantity Produced'
-        total_kg = annual_operating.loc[line][basis]
-        additional_days_production = (total_kg / median / 24) - (total_kg / target / 24)
-    if metric == 'Yield':
-        basis = 'Run Time'
-        total_kg = annual_operating.loc[line][basis]
-        additional_days_production = (total_kg / 24) - (total_kg * median / target / 24)
-    if metric == 'Uptime':
-        additional_days_production = (target - median) /24
-    return additional_days_production
-
-def calculate_equivalent_days(df):
-    quantiles = np.arange(50,101,1)
-    quantiles = quantiles*.01
-    quantiles = np.round(quantiles, decimals=2)
-    asset_metrics = ['Yield', 'Rate', 'Uptime']
+# family, technology and share of the products in the plant exports
+PRODUCT_TYPES = [('OTHER', 'WATERBASE', 0.39), ('COAT', 'CLEARCOAT', 0.12),
+                 ('COAT', 'Ecoat', 0.11), ('SOLVENT', 'SOLVENTBASE', 0.17),
+                 ('PRIMER', 'WBPRIMER', 0.10), ('PRIMER', 'SBPRIMER', 0.06),
+                 ('LIQUID', 'A-LIQUID', 0.03), ('OTHER', 'RAWMATERIAL', 0.01),
+                 ('OTHER', 'I-PRETREAT', 0.01)]
+COST_CENTERS = ['2', '3', '4', '5', '6', '7', '9', 'Q']
+
+def generate_production_data(rows=10000, seed=0, sites=('Cleveland',),
+                             products=600, tanks=300, start='2019-01-01',
+                             days=365):
+    """
+    synthetic batches with the columns and dtypes read_production_csv gives
+    for data/test.csv, for load testing the dashboard beyond the plant
+    exports
+
+    Products have a fixed family, technology and cost center and their own
+    typical batch size and approval time, so the analytics have groups to
+    find. Hours and gaps between dates are lognormal around the medians of
+    the exports, with missing values at about the same rates.
+
+    Parameters
+    ----------
+    rows: int, default 10000
+        number of batches
+    seed: int, default 0
+        the same seed and arguments give the same frame
+    sites: sequence of str
+        sites the batches are spread over
+    products, tanks: int
+        number of distinct products and tank numbers
+    start: str, default 2019-01-01
+        first day batches start on
+    days: int, default 365
+        length of the window batches start in
+
+    Returns
+    -------
+    df: DataFrame
+        one row per batch, descriptors as categoricals
+    """
+    state = np.random.RandomState(seed)
+    def hours(median, sigma, size=rows):
+        return median * np.exp(sigma * state.standard_normal(size))
+    def missing(values, share):
+        return np.where(state.random_sample(rows) < share, np.nan, values)
+    def timedelta(hours):
+        return pd.to_timedelta(np.round(hours * 3600), unit='s')
+    def categorical(codes, names):
+        return pd.Categorical.from_codes(codes, names)
+
+    kinds = state.choice(len(PRODUCT_TYPES), products,
+                         p=[share for family, tech, share in PRODUCT_TYPES])
+    product = state.randint(products, size=rows)
+    kind = kinds[product]
+    cost_center = state.randint(len(COST_CENTERS), size=products)[product]
+    # a few products run on other cost centers
+    moved = state.random_sample(rows) < 0.05
+    cost_center[moved] = state.randint(len(COST_CENTERS), size=moved.sum())
+    tank_weights = 1 / np.arange(1, tanks + 1)
+    tank = state.choice(tanks, rows, p=tank_weights / tank_weights.sum())
+    tank[state.random_sample(rows) < 0.29] = -1
+    family = np.array([family for family, tech, share in PRODUCT_TYPES])
+    technology = np.array([tech for family, tech, share in PRODUCT_TYPES])
+
+    quantity = np.maximum(50, np.round(hours(1500, 0.8, products)[product] *
+                                       hours(1, 0.3), 2))
+    pa_time = missing(hours(15, 1.0), 0.02)
+    cm_time = missing(hours(150, 0.7), 0.54)
+    approval = hours(120, 0.6, products)[product] * hours(1, 0.6)
+    filling = missing(hours(20, 1.0) * (quantity / 1500) ** 0.3, 0.025)
+    total = approval + np.nan_to_num(pa_time) + np.nan_to_num(filling) + hours(100, 0.5)
+    approved = state.random_sample(rows) >= 0.12
+
+    window = days * 24 * 3600
+    first = pd.Timestamp(start) + pd.to_timedelta(
+        np.round(state.random_sample(rows) * window), unit='s')
+    logged = first + timedelta(hours(28, 0.8))
+    completed = (logged + timedelta(hours(160, 0.7))).normalize()
+    first = first.where(state.random_sample(rows) >= 0.02)
+
+    columns = OrderedDict([
+        ('Family', categorical(np.where(state.random_sample(rows) < 0.003, -1,
+                                        np.unique(family, return_inverse=True)[1][kind]),
+                               np.unique(family))),
+        ('Tank Number', categorical(tank, ['Tote'] + ['T{} B{}'.format(500 + i, 8 + i % 97)
+                                                      for i in range(1, tanks)])),
+        ('Cost Center', categorical(cost_center, COST_CENTERS)),
+        ('Technology', categorical(np.unique(technology, return_inverse=True)[1][kind],
+                                   np.unique(technology))),
+        ('Product', categorical(product, ['P{:06d}'.format(i) for i in range(products)])),
+        ('Parent Batch Actual Qty', quantity),
+        ('PA Time', timedelta(pa_time)),
+        ('Tot. CM Time', timedelta(cm_time)),
+        ('80 appv.', timedelta(np.where(approved, approval, np.nan))),
+        ('Filling Time', timedelta(filling)),
+        ('Tot. Time', timedelta(total)),
+        ('Batch Completion Date', completed),
+        ('First Formulated Consumed Material', first),
+        ('TO.80 Log Date', logged.where(approved)),
+        ('Site', categorical(state.randint(len(sites), size=rows), list(sites))),
+    ])
+    return pd.DataFrame(columns)
+
+def synthetic_preset(rows, seed=0, progress=None):
+    """
+    key of a generated dataset in the dataset store, generating it on first
+    use like ingest_preset does for the preset CSVs, large ones are meant to
+    run as a job through submit_job
+    """
+    manifest = _manifest_path('synthetic', rows, seed)
+    entry = read_manifest(manifest)
+    if (entry is not None) and os.path.exists(_dataset_path(entry['key'])):
+        return entry['key']
+    df = generate_production_data(rows, seed)
+    if progress is not None:
+        progress(0.5)
+    key = register_dataset(df)
+    write_manifest(manifest, {'rows': rows, 'seed': seed, 'key': key})
+    return key
+
+def calculate_equivalent_days(df, year=None, window=None,
+                              quantiles=np.round(np.arange(0.5, 1.001, 0.01), 2),
+                              date_column='From Date/Time'):
+    """
+    additional days of production every line and product group would gain
+    by running Rate, Yield and Uptime at each quantile instead of its median
+
+    Parameters
+    ----------
+    year: int, optional
+        calendar year the operating totals (Net Quantity Produced, Run Time)
+        are taken over
+    window: (start, end), optional
+        date range the operating totals are taken over instead of a year,
+        all rows when neither is given
+    quantiles: array, default 0.50 to 1.00 by 0.01
+        targets, must include 0.5
+
+    Returns
+    -------
+    annual_operating: DataFrame
+        Net Quantity Produced and Run Time in hours per group over the
+        window
+    opportunity: DataFrame
+        Rate, Yield and Uptime columns of additional days indexed by Basis,
+        Line, quantile and Product group
+    """
+    asset_metrics = ['Rate', 'Yield', 'Uptime']
     groupby = ['Line', 'Product group']
-    res = df.groupby(groupby)[asset_metrics].quantile(quantiles)#.unstack(level=1)
-
-    prod = df.loc[oee["From Date/Time"].dt.year == 2019].groupby(groupby)['Net Quantity Produced'].sum()
-    time = df.loc[oee["From Date/Time"].dt.year == 2019].groupby(groupby)['Run Time'].sum()
-    annual_operating = pd.merge(prod, time, left_index=True, right_index=True)
-    annual_operating['Run Time'] = annual_operating['Run Time'].dt.total_seconds()/60/60
-
-    metrics = ['Rate', 'Yield', 'Uptime']
-    bases=['Additional Days']
-    lines = df.Line.unique()
-
-    opportunity = pd.DataFrame()
-
-    for line in lines:
-        for basis in bases:
-            metric = metrics[0]
-            temp1 = opportunity_conversion_days(res.loc[line][metric], annual_operating,
-                                          metric=metric, basis=basis, line=line)
-            temp1 = pd.DataFrame(temp1)
-            temp1.columns = ['{}'.format(metric)]
-            temp1 = pd.concat([temp1], keys=['{}'.format(line)], names=['Line'])
-            temp1 = pd.concat([temp1], keys=['{}'.format(basis)], names=['Basis'])
-
-            metric = metrics[1]
-            temp2 = opportunity_conversion_days(res.loc[line][metric], annual_operating,
-                                          metric=metric, basis=basis, line=line)
-            temp2 = pd.DataFrame(temp2)
-            temp2.columns = ['{}'.format(metric)]
-            temp2 = pd.concat([temp2], keys=['{}'.format(line)], names=['Line'])
-            temp2 = pd.concat([temp2], keys=['{}'.format(basis)], names=['Basis'])
-
-            metric = metrics[2]
-            temp3 = opportunity_conversion_days(res.loc[line][metric], annual_operating,
-                                          metric=metric, basis=basis, line=line)
-            temp3 = pd.DataFrame(temp3)
-            temp3.columns = ['{}'.format(metric)]
-            temp3 = pd.concat([temp3], keys=['{}'.format(line)], names=['Line'])
-            temp3 = pd.concat([temp3], keys=['{}'.format(basis)], names=['Basis'])
-
-            df2 = pd.merge(temp1, temp2, left_index=True, right_index=True)
-            df2 = pd.merge(df2, temp3, left_index=True, right_index=True)
-
-
-            opportunity = pd.concat([opportunity, df2], sort=False)
+    quantiles = np.asarray(quantiles, dtype=float)
+    res = aggregate_groups(df, groupby, [(metric, q) for metric in asset_metrics
+                                         for q in quantiles])
+    # groups x metrics x quantiles
+    target = res.values.reshape(res.shape[0], len(asset_metrics), len(quantiles))
+    median = target[:, :, np.flatnonzero(np.isclose(quantiles, 0.5))[0]]
+
+    dates = df[date_column]
+    if window is not None:
+        operating = df.loc[(dates >= window[0]) & (dates <= window[1])]
+    elif year is not None:
+        operating = df.loc[dates.dt.year == year]
+    else:
+        operating = df
+    operating = operating[groupby + ['Net Quantity Produced']].assign(
+        **{'Run Time': _numeric(operating['Run Time'])})
+    annual_operating = aggregate_groups(operating, groupby, [
+        ('Net Quantity Produced', 'sum'), ('Run Time', 'sum')])
+    annual_operating.columns = ['Net Quantity Produced', 'Run Time']
+    totals = annual_operating.reindex(res.index).values
+
+    # rate and yield lose median / target of the time spent producing the
+    # totals, uptime gains the difference in hours directly
+    with np.errstate(divide='ignore', invalid='ignore'):
+        hours = np.column_stack([totals[:, 0] / median[:, 0], totals[:, 1],
+                                 np.full(res.shape[0], np.nan)])
+        days = hours[:, :, None] / 24 * (1 - median[:, :, None] / target)
+        days[:, 2] = (target[:, 2] - median[:, 2, None]) / 24
+
+    lines, groups = [np.repeat(res.index.get_level_values(level).values, len(quantiles))
+                     for level in groupby]
+    index = pd.MultiIndex.from_arrays(
+        [np.repeat('Additional Days', lines.shape[0]), lines,
+         np.tile(quantiles, res.shape[0]), groups],
+        names=['Basis', 'Line', None, 'Product group'])
+    opportunity = pd.DataFrame(days.transpose(0, 2, 1).reshape(-1, len(asset_metrics)),
+                               index=index, columns=asset_metrics).sort_index()
     return annual_operating, opportunity
 
 def my_median_test(df,
                    metric='Yield', 
                    descriptors = ['Product group', 'Line', 'Shift'],
                    stat_cut_off=1e-2,
-                   continuous=False):
+                   continuous=False,
+                   permutations=0,
+                   seed=0,
+                   processes=None,
+                   method='pearson'):
     """
     Parameters
     ----------
@@ -123,6 +279,18 @@ def my_median_test(df,
         I guess jajajaj)
     stat_cut_off: float, default 1e-2
         p-test cutoff (<0.01 chance of null hypothesis)
+    permutations: int, default 0
+        when above 0, p is the share of that many shuffles of the metric
+        column with a statistic at least as large as the observed one,
+        instead of the asymptotic chi-square p-value
+    seed: int, default 0
+        seed of the shuffles, results do not depend on processes
+    processes: int, optional
+        worker processes for the shuffles, defaults to the number of
+        cores, 1 runs inline
+    method: str, default pearson
+        pearson or spearman, correlation of numeric descriptors with the
+        metric when continuous
 
     Returns
     -------
@@ -130,43 +298,1586 @@ def my_median_test(df,
         Moods Median Test Results for Metric
     """
     if continuous:
-        moods = []
-        for descriptor in descriptors:
-            stat, p = stats.pearsonr(production_df[metric], production_df[descriptor])
-            moods.append([descriptor, stat, p])
-        stat_df = pd.DataFrame(moods)
-        stat_df.columns = ['descriptor', 'stat', 'p']
+        stat, p = correlate(df, metric, descriptors, method)
+        stat_df = pd.DataFrame(OrderedDict([('descriptor', list(descriptors)),
+                                            ('stat', stat), ('p', p)]))
         stat_df = stat_df.sort_values(by='stat', ascending=False).reset_index(drop=True)
         stat_df = stat_df.loc[stat_df['p'] < stat_cut_off].drop_duplicates('stat').reset_index(drop=True)
         stat_df['score'] = stat_df['stat']
         stat_df = stat_df.reset_index(drop=True)
     else:
         moods = []
-        for descriptor in descriptors:
-            for item in df[descriptor].unique():
-                try:
-                    stat, p, m, table = stats.median_test(df.loc[df[descriptor] == item][metric],
-                                           df.loc[~(df[descriptor] == item)][metric], nan_policy='omit')
-                    moods.append([descriptor, item, stat, p, m, table])
-                except:
-                    pass
-        stat_df = pd.DataFrame(moods)
-        stat_df.columns = ['descriptor', 'group', 'stat', 'p', 'm', 'table']
+        values = df[metric].values.astype(float)
+        valid = ~np.isnan(values)
+        grand_median = np.median(values[valid])
+        labels = valid.astype(np.int8) + (valid & (values > grand_median))
+        factorized = [pd.factorize(df[descriptor]) for descriptor in descriptors]
+        codes = [code for code, groups in factorized]
+        observed = []
+        for descriptor, (code, groups) in zip(descriptors, factorized):
+            table, ok = _median_tables(code, len(groups), labels)
+            stat = _yates_statistic(table[..., ok])
+            p = stats.chi2.sf(stat, 1)
+            observed.append(np.full(len(groups), np.nan))
+            observed[-1][ok] = stat
+            for i, group in enumerate(np.nonzero(ok)[0]):
+                moods.append([descriptor, groups[group], stat[i], p[i],
+                              grand_median, table[..., group]])
+        if permutations > 0:
+            exceed = _permutation_counts(labels, codes, observed, permutations,
+                                         seed, processes)
+            p = np.concatenate([(hits + 1) / (permutations + 1) for hits in exceed])
+            p = p[~np.isnan(np.concatenate(observed))]
+            for row, value in zip(moods, p):
+                row[3] = value
+        stat_df = pd.DataFrame(moods, columns=['descriptor', 'group', 'stat', 'p', 'm', 'table'])
         stat_df = stat_df.sort_values(by='stat', ascending=False).reset_index(drop=True)
         stat_df = stat_df.loc[stat_df['p'] < stat_cut_off].drop_duplicates('stat').reset_index(drop=True)
-        scores = []
-        for index in range(stat_df.shape[0]):
-            x = df.loc[(df[stat_df.iloc[index]['descriptor']] == \
-                        stat_df.iloc[index]['group'])][metric]
-            y = df.loc[(df[stat_df.iloc[index]['descriptor']] == \
-                        stat_df.iloc[index]['group'])][metric].median()
-            y = df.loc[(df[stat_df.iloc[index]['descriptor']] ==
-                stat_df.iloc[index]['group'])][stat_df.iloc[index]['descriptor']]
+        table = np.array(list(stat_df['table'])).reshape(-1, 2, 2)
+        with np.errstate(divide='ignore', invalid='ignore'):
             if metric == 'Uptime':
-                scores.append(stat_df['table'][index][1][0] / stat_df['table'][index][0][0])
+                stat_df['score'] = table[:, 1, 0] / table[:, 0, 0]
             else:
-                scores.append(stat_df['table'][index][0][0] / stat_df['table'][index][1][0])
-        stat_df['score'] = scores
+                stat_df['score'] = table[:, 0, 0] / table[:, 1, 0]
         stat_df = stat_df.sort_values('score', ascending=True)
         stat_df = stat_df.reset_index(drop=True)
     return stat_df
+
+def _numeric(values):
+    """
+    float values of a numeric or timedelta column, timedeltas in hours
+    """
+    if values.dtype.kind == 'm':
+        return values.dt.total_seconds().values / 60 / 60
+    return values.values.astype(float, copy=False)
+
+def correlate(df, metric, descriptors, method='pearson'):
+    """
+    correlation of every numeric descriptor with the metric and its two
+    sided p-value, as scipy's pearsonr or spearmanr give on the rows where
+    both are present
+
+    Parameters
+    ----------
+    method: str, default pearson
+        pearson or spearman
+
+    Returns
+    -------
+    stat, p: ndarray
+        one per descriptor, nan with fewer than three rows or a constant
+        column
+    """
+    # one row per descriptor, so every reduction runs over contiguous memory
+    x = np.array([_numeric(df[col]) for col in descriptors])
+    y = _numeric(df[metric])[None, :]
+    mask = ~np.isnan(x) & ~np.isnan(y)
+    if method == 'spearman':
+        x = pd.DataFrame(np.where(mask, x, np.nan)).rank(axis=1).values
+        y = pd.DataFrame(np.where(mask, y, np.nan)).rank(axis=1).values
+    elif method != 'pearson':
+        raise ValueError('method must be pearson or spearman')
+    n = mask.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # shifted by the pairwise means first so the moments below do not cancel
+        x = np.where(mask, x, 0)
+        x = (x - (x.sum(axis=1) / n)[:, None]) * mask
+        y = np.where(mask, y, 0)
+        y = (y - (y.sum(axis=1) / n)[:, None]) * mask
+        sx, sy = x.sum(axis=1), y.sum(axis=1)
+        sxy = np.einsum('ij,ij->i', x, y) - sx * sy / n
+        sxx = np.einsum('ij,ij->i', x, x) - sx * sx / n
+        syy = np.einsum('ij,ij->i', y, y) - sy * sy / n
+        stat = np.clip(sxy / np.sqrt(sxx * syy), -1, 1)
+        t = stat * np.sqrt((n - 2) / (1 - stat * stat))
+        p = 2 * stats.t.sf(np.abs(t), n - 2)
+    stat[n < 3] = np.nan
+    p[np.isnan(stat)] = np.nan
+    return stat, p
+
+def _median_tables(codes, n_groups, labels):
+    """
+    group vs rest 2 x 2 tables of rows above and not above the grand
+    median, from labels 0 missing, 1 not above and 2 above, shaped
+    (2, 2, n_groups) or (2, 2, shuffles, n_groups) for one row of labels
+    per shuffle, and whether scipy's median_test would accept each table
+    """
+    # missing descriptors get their own trailing group
+    codes = np.where(codes < 0, n_groups, codes)
+    shape = labels.shape[:-1] + (n_groups + 1, 3)
+    offset = np.arange(int(np.prod(labels.shape[:-1]))).reshape(labels.shape[:-1] + (1,))
+    cells = (offset * (n_groups + 1) + codes) * 3 + labels
+    counts = np.bincount(cells.ravel(), minlength=int(np.prod(shape))).reshape(shape)
+    total = counts[..., 1:].sum(axis=(-2, -1))[..., None]
+    total_above = counts[..., 2].sum(axis=-1)[..., None]
+    count = counts[..., :n_groups, 1] + counts[..., :n_groups, 2]
+    count_above = counts[..., :n_groups, 2]
+    table = np.stack([[count_above, total_above - count_above],
+                      [count - count_above, total - total_above - count + count_above]])
+    # scipy raises for an empty row or column, those groups are skipped
+    ok = (count > 0) & (count < total) & (total_above > 0) & (total_above < total)
+    return table, ok
+
+def _permutation_block(args):
+    """
+    number of shuffles of one block with a statistic at least the observed
+    one, for every group of every descriptor
+    """
+    labels, codes, observed, seed, size = args
+    state = np.random.RandomState(seed)
+    shuffled = np.stack([state.permutation(labels) for i in range(size)])
+    exceed = []
+    for code, stat in zip(codes, observed):
+        table, ok = _median_tables(code, stat.shape[0], shuffled)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shuffled_stat = _yates_statistic(table)
+        # shuffles that scipy would reject count as less extreme
+        shuffled_stat[~ok] = -np.inf
+        exceed.append((shuffled_stat >= stat * (1 - 1e-12)).sum(axis=0))
+    return exceed
+
+def _permutation_counts(labels, codes, observed, permutations,
+                        seed=0, processes=None, block_size=128):
+    """
+    exceedance counts over permutations of the labelled metric column, in
+    blocks of block_size shuffles each seeded from seed and its position so
+    the counts do not depend on how blocks are spread over processes
+    """
+    jobs = [(labels, codes, observed, [seed, block],
+             min(block_size, permutations - start))
+            for block, start in enumerate(range(0, permutations, block_size))]
+    if processes == 1 or len(jobs) == 1:
+        results = [_permutation_block(job) for job in jobs]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(_permutation_block, jobs))
+    return [sum(counts) for counts in zip(*results)]
+
+def _yates_statistic(table):
+    """
+    Pearson chi-square statistic of many 2 x 2 tables shaped (2, 2, ...),
+    with the Yates correction scipy's chi2_contingency applies
+    """
+    table = table.astype(float)
+    expected = table.sum(axis=1, keepdims=True) * table.sum(axis=0, keepdims=True) /\
+        table.sum(axis=(0, 1))
+    diff = expected - table
+    table = table + np.minimum(0.5, np.abs(diff)) * np.sign(diff)
+    terms = (table - expected) ** 2 / expected
+    return terms[0, 0] + terms[0, 1] + terms[1, 0] + terms[1, 1]
+
+def _segment_values(values):
+    values = np.asarray(values)
+    missing = pd.isnull(values)
+    if values.dtype.kind == 'M':
+        values = np.datetime_as_string(values, unit='s')
+    return np.where(missing, None, values)
+
+def segment_arrays(x1, x2, y):
+    """
+    x and y of one line trace drawing a segment per row from (x1, y) to
+    (x2, y), with None between segments so they are not joined
+
+    datetimes are sent as ISO strings, plotly copies those far faster than
+    Timestamp objects
+    """
+    x = np.empty(3 * len(y), dtype=object)
+    x[0::3] = _segment_values(x1)
+    x[1::3] = _segment_values(x2)
+    yy = np.empty(3 * len(y), dtype=object)
+    yy[0::3] = yy[1::3] = _segment_values(y)
+    return x, yy
+
+def downsample_minmax(x, y, budget, groups=None):
+    """
+    row positions of at most about `budget` points keeping the lowest and
+    highest y of every x bucket, per group
+
+    The x range is split into equal buckets (a pixel column each for a
+    budget near the plot width), so extremes and outliers stay visible
+    while dense stretches are thinned. Rows with a missing x, y or group
+    (code -1) are dropped.
+    """
+    x = np.asarray(x)
+    if x.dtype.kind == 'M':
+        x = np.where(pd.isnull(x), np.nan, x.astype('datetime64[ns]').astype('i8'))
+    x = x.astype(float)
+    y = np.asarray(y, dtype=float)
+    groups = np.zeros(x.shape[0], dtype=int) if groups is None else np.asarray(groups)
+    valid = np.nonzero(np.isfinite(x) & np.isfinite(y) & (groups >= 0))[0]
+    if valid.shape[0] <= budget:
+        return valid
+    buckets = max(1, budget // (2 * (groups.max() + 1)))
+    low, high = x[valid].min(), x[valid].max()
+    bucket = ((x[valid] - low) / ((high - low) or 1) * buckets).astype(int)
+    key = groups[valid] * buckets + bucket.clip(0, buckets - 1)
+    order = np.lexsort((y[valid], key))
+    key = key[order]
+    edge = key[1:] != key[:-1]
+    keep = np.concatenate([[True], edge]) | np.concatenate([edge, [True]])
+    return np.sort(valid[order[keep]])
+
+def kde_curve(values, points=200):
+    """
+    gaussian kernel density of values on a fixed grid
+
+    Uses the bandwidth rule and soft span (two bandwidths past the data) of
+    plotly's violins. Samples are linearly binned onto the grid and the
+    kernel is applied as one convolution, so the cost does not grow with
+    grid size times sample count.
+
+    Returns
+    -------
+    grid: array
+    density: array
+    """
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    n = values.shape[0]
+    q1, q3 = np.percentile(values, [25, 75])
+    spread = min(values.std(ddof=1), (q3 - q1) / 1.349) if n > 1 else 0
+    bandwidth = 1.059 * spread * n ** -0.2
+    if not bandwidth > 0:
+        bandwidth = (values.max() - values.min()) / points or abs(values[0]) / 100 or 1
+    grid = np.linspace(values.min() - 2 * bandwidth, values.max() + 2 * bandwidth, points)
+    step = grid[1] - grid[0]
+    position = (values - grid[0]) / step
+    left = np.floor(position).astype(int).clip(0, points - 2)
+    right = position - left
+    counts = np.bincount(left, 1 - right, points) + np.bincount(left + 1, right, points)
+    reach = min(int(np.ceil(4 * bandwidth / step)), points - 1)
+    kernel = np.exp(-0.5 * (np.arange(-reach, reach + 1) * step / bandwidth) ** 2)
+    density = np.convolve(counts, kernel)[reach:reach + points]
+    return grid, density / (n * bandwidth * np.sqrt(2 * np.pi))
+
+def parse_timedelta(values):
+    """
+    vectorized parser for timedeltas formatted as "N days HH:MM:SS.nnnnnnnnn"
+
+    Strings are viewed as a byte matrix, rows are grouped by length so the
+    day and clock digits sit in fixed columns, and the fields are combined
+    with integer arithmetic. Missing values become NaT, anything that does
+    not match the format exactly is handed to pd.to_timedelta.
+    """
+    values = pd.Series(values)
+    if values.dtype.kind == 'm':
+        return values
+    out = np.full(values.shape[0], np.iinfo(np.int64).min, dtype=np.int64)
+    text = values.notnull().values
+    raw = values.values[text]
+    parsed = np.zeros(raw.shape[0], dtype=np.int64)
+    ok = np.zeros(raw.shape[0], dtype=bool)
+    try:
+        m = np.array(raw, dtype='S').view(np.uint8).reshape(raw.shape[0], -1)
+    except (UnicodeEncodeError, TypeError, ValueError):
+        m = np.zeros((raw.shape[0], 0), dtype=np.uint8)
+    length = (m != 0).sum(axis=1)
+    for n in np.unique(length[length >= 25]):
+        rows = np.flatnonzero(length == n)
+        sub = m[rows, :n]
+        days, clock = sub[:, :n - 24], sub[:, n - 18:]
+        match = (sub[:, n - 24:n - 18] == np.frombuffer(b' days ', np.uint8)).all(axis=1)
+        match &= (clock[:, [2, 5]] == ord(':')).all(axis=1) & (clock[:, 8] == ord('.'))
+        days = days.astype(np.int64) - ord('0')
+        clock = np.delete(clock, [2, 5, 8], axis=1).astype(np.int64) - ord('0')
+        match &= ((days >= 0) & (days <= 9)).all(axis=1)
+        match &= ((clock >= 0) & (clock <= 9)).all(axis=1)
+        seconds = (days.dot(10 ** np.arange(n - 25, -1, -1)) * 86400 +
+                   clock[:, :2].dot([36000, 3600]) +
+                   clock[:, 2:4].dot([600, 60]) +
+                   clock[:, 4:6].dot([10, 1]))
+        parsed[rows] = seconds * 10**9 + clock[:, 6:].dot(10 ** np.arange(8, -1, -1))
+        ok[rows] = match
+    if not ok.all():
+        parsed[~ok] = pd.to_timedelta(pd.Series(raw[~ok], dtype=object))\
+            .values.astype('m8[ns]').view(np.int64)
+    out[text] = parsed
+    return pd.Series(out.view('m8[ns]'), index=values.index, name=values.name)
+
+def read_production_csv(filepath_or_buffer, dates, time_components):
+    """
+    read a production export with datetimes and timedeltas in proper format
+    """
+    df = pd.read_csv(filepath_or_buffer, parse_dates=dates)
+    for col in time_components:
+        df[col] = parse_timedelta(df[col])
+    return df
+
+def dataset_id(df):
+    """
+    content hash of a DataFrame, used as the key in the dataset store
+    """
+    h = hashlib.sha1()
+    h.update(str(list(df.columns)).encode('utf-8'))
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()[:16]
+
+def _is_key(key):
+    return (isinstance(key, str) and len(key) == 16 and
+            all(c in '0123456789abcdef' for c in key))
+
+def _dataset_path(key):
+    if not _is_key(key):
+        raise KeyError('unknown dataset: {}'.format(key))
+    return os.path.join(DATASET_DIR, key)
+
+def type_dataset(df, max_category_ratio=0.5):
+    """
+    convert low cardinality text columns (the descriptors) to categoricals
+    """
+    for col in df.select_dtypes(include='object').columns:
+        if df[col].nunique() <= max_category_ratio * df.shape[0]:
+            df[col] = df[col].astype('category')
+    return df
+
+def _nbytes(value):
+    """
+    private bytes held by a cached value, arrays over the mapped dataset
+    files count as 0
+    """
+    if isinstance(value, np.ndarray):
+        return 0 if _is_mapped(value) else value.nbytes
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        return int(np.sum(value.memory_usage(deep=True)))
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_nbytes(k) + _nbytes(v)
+                                          for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_nbytes(v) for v in value)
+    if hasattr(value, '__dict__'):
+        return _nbytes(vars(value))
+    return sys.getsizeof(value)
+
+def _cache_lookup(name, key):
+    """
+    entry of one of the _CACHES, marked as most recently used, None if missing
+    """
+    with _DATASET_LOCK:
+        cache = _CACHES[name]
+        if key not in cache:
+            return None
+        cache.move_to_end(key)
+        _CACHE_BYTES.move_to_end((name, key))
+        return cache[key]
+
+def _cache_store(name, key, value, nbytes=None, size=None):
+    """
+    put value in one of the _CACHES and return it
+
+    Past `size` entries the least recently used entries of that cache are
+    evicted. All caches share DATASET_CACHE_BYTES: the least recently used
+    entries of any cache are evicted until their private bytes fit, and the
+    newest entry is always kept.
+    """
+    nbytes = _nbytes(value) if nbytes is None else nbytes
+    with _DATASET_LOCK:
+        cache = _CACHES[name]
+        cache[key] = value
+        cache.move_to_end(key)
+        _CACHE_BYTES[name, key] = nbytes
+        _CACHE_BYTES.move_to_end((name, key))
+        while (size is not None) and (len(cache) > size):
+            old, _ = cache.popitem(last=False)
+            del _CACHE_BYTES[name, old]
+        total = sum(_CACHE_BYTES.values())
+        while (len(_CACHE_BYTES) > 1) and (total > DATASET_CACHE_BYTES):
+            (old_name, old), old_bytes = _CACHE_BYTES.popitem(last=False)
+            del _CACHES[old_name][old]
+            total -= old_bytes
+    return value
+
+def cache_info():
+    """
+    entries and private bytes of every in-process cache
+    """
+    with _DATASET_LOCK:
+        info = {name: {'size': len(cache), 'bytes': 0}
+                for name, cache in _CACHES.items()}
+        for (name, _), nbytes in _CACHE_BYTES.items():
+            info[name]['bytes'] += nbytes
+    return info
+
+def _cache_dataset(key, df, mapped=0):
+    _cache_store('datasets', key, df,
+                 int(df.memory_usage(deep=True).sum()) - mapped)
+
+class DatasetWriter:
+    """
+    write typed DataFrame chunks as one memory-mappable file per column
+
+    Numeric, datetime and timedelta columns are written as raw arrays,
+    categorical and text columns as integer codes with their sorted
+    categories in meta.json. The dataset is written to a temporary directory and renamed
+    into DATASET_DIR under its content hash on close, so concurrent
+    workers never see a partial dataset.
+    """
+    def __init__(self):
+        os.makedirs(DATASET_DIR, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix='.tmp-', dir=DATASET_DIR)
+        self.columns = None
+        self.rows = 0
+        self._hash = hashlib.sha1()
+        self._codes = []
+
+    def append(self, df):
+        if self.columns is None:
+            self._hash.update(str(list(df.columns)).encode('utf-8'))
+            self.columns = []
+            for name in df.columns:
+                if (df[name].dtype == object) or\
+                   (df[name].dtype.name == 'category'):
+                    kind = 'object' if df[name].dtype == object else 'category'
+                    self.columns.append({'name': name, 'kind': kind,
+                                         'dtype': 'int32', 'categories': []})
+                else:
+                    self.columns.append({'name': name, 'kind': 'array',
+                                         'dtype': df[name].dtype.str})
+                self._codes.append({})
+        self._hash.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+        for i, col in enumerate(self.columns):
+            values = df[col['name']]
+            if col['kind'] == 'array':
+                values = values.values.astype(col['dtype'], copy=False)
+            else:
+                codes, uniques = pd.factorize(values)
+                if hasattr(uniques, 'categories'):
+                    uniques = uniques.astype(object)
+                lookup = np.array([self._code(i, u) for u in uniques] + [-1],
+                                  dtype='int32')
+                values = lookup[codes]
+            with open(os.path.join(self.path, '{}.bin'.format(i)), 'ab') as f:
+                f.write(np.ascontiguousarray(values).tobytes())
+        self.rows += df.shape[0]
+
+    def _code(self, i, value):
+        codes = self._codes[i]
+        if value not in codes:
+            codes[value] = len(codes)
+            self.columns[i]['categories'].append(value)
+        return codes[value]
+
+    def close(self):
+        """
+        finalize the dataset and return its key
+        """
+        key = self._hash.hexdigest()[:16]
+        for i, col in enumerate(self.columns):
+            if col['kind'] != 'array':
+                self._recode(i, col)
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({'rows': self.rows, 'columns': self.columns}, f,
+                      default=str)
+        try:
+            os.rename(self.path, _dataset_path(key))
+        except OSError:
+            # an identical dataset was written by another worker
+            shutil.rmtree(self.path, ignore_errors=True)
+        return key
+
+    def _recode(self, i, col):
+        """
+        sort the categories and store the codes in the narrowest integer
+        type, the layout pandas keeps categorical codes in, so readers can
+        use the mapped codes as they are
+        """
+        categories = col['categories']
+        try:
+            order = sorted(range(len(categories)), key=categories.__getitem__)
+        except TypeError:
+            order = list(range(len(categories)))
+        lookup = np.empty(len(categories) + 1, dtype=np.int64)
+        lookup[order] = np.arange(len(categories))
+        lookup[-1] = -1
+        dtype = next(t for t in ['int8', 'int16', 'int32', 'int64']
+                     if len(categories) < np.iinfo(t).max)
+        path = os.path.join(self.path, '{}.bin'.format(i))
+        codes = np.fromfile(path, dtype=col['dtype'])
+        lookup[codes].astype(dtype).tofile(path)
+        col['categories'] = [categories[j] for j in order]
+        col['dtype'] = dtype
+
+def _read_dataset(path, max_category_ratio=0.5):
+    """
+    frame over the column files of a stored dataset and the number of its
+    bytes that stay in the page cache, shared by every worker
+
+    Numeric, datetime and timedelta columns and the codes of categoricals
+    are read-only views of the mapped files. Only text columns with too
+    many distinct values for a categorical are materialized.
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    data = OrderedDict()
+    mapped = 0
+    for i, col in enumerate(meta['columns']):
+        if meta['rows'] > 0:
+            values = np.memmap(os.path.join(path, '{}.bin'.format(i)),
+                               dtype=col['dtype'], mode='r',
+                               shape=(meta['rows'],))
+        else:
+            values = np.empty(0, dtype=col['dtype'])
+        if col['kind'] == 'array':
+            mapped += values.nbytes
+        elif (col['kind'] == 'object') and\
+             (len(col['categories']) > max_category_ratio * meta['rows']):
+            values = np.asarray(pd.Categorical.from_codes(values, col['categories']),
+                                dtype=object)
+        else:
+            values = pd.Categorical.from_codes(values, col['categories'])
+            mapped += values.codes.nbytes if _is_mapped(values.codes) else 0
+        data[col['name']] = values
+    return _block_per_column(data, meta['rows']), mapped
+
+def _block_per_column(data, rows):
+    """
+    DataFrame over the arrays of data without copying them
+
+    The DataFrame constructor of pandas 0.24 stacks columns of one dtype
+    into a new block, and later operations on a frame consolidate its blocks
+    in place, both of which copy. The block manager is built with one block
+    per column and marked consolidated so pandas keeps the views.
+    """
+    from pandas.core.internals import BlockManager, make_block
+    blocks = [make_block(values.reshape(1, -1) if isinstance(values, np.ndarray)
+                         else values, placement=[i], ndim=2)
+              for i, values in enumerate(data.values())]
+    manager = BlockManager(blocks, [pd.Index(list(data)), pd.RangeIndex(rows)])
+    manager._is_consolidated = manager._known_consolidated = True
+    return pd.DataFrame(manager)
+
+def _is_mapped(values):
+    while values is not None:
+        if isinstance(values, (np.memmap, mmap.mmap)):
+            return True
+        values = getattr(values, 'base', None)
+    return False
+
+def register_dataset(df):
+    """
+    put a typed DataFrame in the dataset store and return its key
+
+    The frame is written to DATASET_DIR and this process maps it back like
+    every other gunicorn worker does, so no worker keeps a private copy.
+    """
+    key = dataset_id(df)
+    if not os.path.exists(_dataset_path(key)):
+        writer = DatasetWriter()
+        writer.append(type_dataset(df))
+        writer.close()
+    decode_dataset(key)
+    return key
+
+def decode_dataset(key):
+    """
+    memoized decode of a stored dataset into a typed DataFrame
+
+    Decoded frames are read-only views of the mapped files, shared between
+    callbacks and with the other workers through the page cache, and must
+    not be modified, use get_dataset for a private copy. The least recently
+    used frames are evicted with the other caches once their private bytes
+    (text columns and categories) exceed DATASET_CACHE_BYTES.
+    """
+    df = _cache_lookup('datasets', key)
+    if df is not None:
+        return df
+    path = _dataset_path(key)
+    if not os.path.exists(path):
+        raise KeyError('unknown dataset: {}'.format(key))
+    df, mapped = _read_dataset(path)
+    _cache_dataset(key, df, mapped)
+    return df
+
+def get_dataset(key):
+    """
+    fetch a private copy of a registered DataFrame by key
+    """
+    return decode_dataset(key).copy()
+
+def _digest(*parts):
+    source = json.dumps(parts, default=str, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(source).hexdigest()[:16]
+
+def _manifest_path(kind, *parts):
+    return os.path.join(DATASET_DIR, '{}-{}.json'.format(kind, _digest(*parts)))
+
+def read_manifest(path):
+    """
+    small json record kept next to the datasets, None if missing
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def write_manifest(path, entry):
+    """
+    atomically replace a json record so other workers never read half of it
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+    with open(tmp, 'w') as f:
+        json.dump(entry, f, default=str)
+    os.replace(tmp, path)
+
+def ingest_preset(path, dates, time_components):
+    """
+    key of a preset CSV in the dataset store, ingesting it on first use
+
+    A small manifest next to the dataset records the source mtime and size,
+    the CSV is only parsed again when the source file changes.
+    """
+    stat = os.stat(path)
+    stamp = [stat.st_mtime_ns, stat.st_size]
+    manifest = _manifest_path('preset', os.path.abspath(path))
+    entry = read_manifest(manifest)
+    if (entry is not None) and (entry['stamp'] == stamp) and\
+       os.path.exists(_dataset_path(entry['key'])):
+        return entry['key']
+    key = register_dataset(read_production_csv(path, dates, time_components))
+    write_manifest(manifest, {'source': path, 'stamp': stamp, 'key': key})
+    return key
+
+class Base64Reader(io.RawIOBase):
+    """
+    binary file view of a dcc.Upload payload, base64 decoded block by block
+    """
+    def __init__(self, contents, block_size=2**20):
+        self.contents = contents
+        self.position = contents.index(',') + 1
+        self.block_size = block_size - block_size % 4
+        self.total = (len(contents) - self.position) * 3 // 4
+        self.done = 0
+        self._buffer = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while (len(self._buffer) == 0) and (self.position < len(self.contents)):
+            block = self.contents[self.position:self.position + self.block_size]
+            self.position += len(block)
+            self._buffer = memoryview(base64.b64decode(block))
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        self.done += n
+        return n
+
+def _upload_schema(sample, dates, time_components, text=()):
+    """
+    dtypes that every chunk of an upload is read with, inferred from a sample,
+    columns in text are read as text whatever the sample holds
+    """
+    schema = {}
+    for col in sample.columns:
+        if col in dates or col in time_components or col in text:
+            schema[col] = object
+        elif (sample[col].dtype.kind in 'biuf') and sample[col].notnull().any():
+            schema[col] = np.float64
+        else:
+            schema[col] = object
+    return schema
+
+def _type_chunk(chunk, schema, dates, time_components):
+    """
+    convert a chunk to the schema, returns the chunk and the numeric columns
+    that hold values other than numbers in this chunk
+    """
+    widen = []
+    for col, dtype in schema.items():
+        if col in dates:
+            chunk[col] = pd.to_datetime(chunk[col])
+        elif col in time_components:
+            values = pd.to_numeric(chunk[col], errors='coerce')
+            if values.notnull().sum() == chunk[col].notnull().sum():
+                # spreadsheets store durations as fractional days
+                chunk[col] = pd.to_timedelta(values, unit='D').round('s')
+            else:
+                chunk[col] = parse_timedelta(chunk[col])
+        elif dtype is object:
+            chunk[col] = chunk[col].astype(object)
+        else:
+            values = pd.to_numeric(chunk[col], errors='coerce')
+            if values.notnull().sum() != chunk[col].notnull().sum():
+                widen.append(col)
+            chunk[col] = values.astype(dtype)
+    return chunk, widen
+
+def _excel_chunks(path, chunksize):
+    import openpyxl
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    sheet = workbook.worksheets[0]
+    rows = sheet.iter_rows(values_only=True)
+    columns = list(next(rows))
+    total = max((sheet.max_row or 1) - 1, 1)
+    block = []
+    done = 0
+    for row in rows:
+        block.append(row)
+        if len(block) == chunksize:
+            done += len(block)
+            yield pd.DataFrame(block, columns=columns), done / total
+            block = []
+    if block or not done:
+        yield pd.DataFrame(block, columns=columns), 1.0
+    workbook.close()
+
+def spool_upload(contents, filename):
+    """
+    decode a dcc.Upload payload block by block into a file named by the hash
+    of its bytes and return the path, so a job can be submitted with the
+    path alone
+
+    Spooled files are removed by the ingest that reads them, ones left by a
+    job that had already run expire after PPG_REQUEST_TTL seconds.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in ['.csv', '.xlsx', '.xlsm']:
+        raise ValueError('unsupported file type: {}'.format(filename))
+    folder = os.path.join(DATASET_DIR, 'uploads')
+    os.makedirs(folder, exist_ok=True)
+    _expire(folder)
+    digest = hashlib.sha1()
+    reader = io.BufferedReader(Base64Reader(contents))
+    with tempfile.NamedTemporaryFile(prefix='.tmp-', dir=folder, delete=False) as f:
+        for block in iter(lambda: reader.read(2**20), b''):
+            digest.update(block)
+            f.write(block)
+    path = os.path.join(folder, digest.hexdigest()[:16] + extension)
+    os.replace(f.name, path)
+    return path
+
+def ingest_upload(path, dates, time_components, chunksize=50000, progress=None):
+    """
+    stream an upload spooled by spool_upload into the dataset store and
+    return its key, the spooled file is removed afterwards
+
+    Column types are inferred from the first chunk. When a column that
+    looked numeric holds text further down, it is read as text and the file
+    is streamed again, so descriptors like a Cost Center of 1 to 8 and Q keep
+    their labels as they do when a preset is read.
+
+    Parameters
+    ----------
+    path: str
+        spooled .csv or .xlsx file
+    chunksize: int, default 50000
+        rows decoded, typed and written per step, which bounds peak memory
+    progress: callable, optional
+        called with the fraction of the file ingested after every chunk
+
+    Returns
+    -------
+    key: str
+        dataset key for get_dataset
+    """
+    text = set()
+    try:
+        while True:
+            writer = DatasetWriter()
+            try:
+                widen = _write_upload(writer, path, dates, time_components,
+                                      chunksize, progress, text)
+            except Exception:
+                shutil.rmtree(writer.path, ignore_errors=True)
+                raise
+            if not widen:
+                return writer.close()
+            shutil.rmtree(writer.path, ignore_errors=True)
+            text.update(widen)
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _write_upload(writer, path, dates, time_components, chunksize, progress,
+                  text):
+    """
+    append the typed chunks of an upload to writer, stops at the first chunk
+    with text in a numeric column and returns those columns
+    """
+    if path.lower().endswith('.csv'):
+        schema = _upload_schema(pd.read_csv(path, nrows=chunksize), dates,
+                                time_components, text)
+        total = max(os.path.getsize(path), 1)
+        with open(path, 'rb') as f:
+            # numeric columns are left to the parser, so text in them is
+            # caught by _type_chunk rather than failing the read
+            for chunk in pd.read_csv(f, chunksize=chunksize,
+                                     dtype={col: dtype for col, dtype in schema.items()
+                                            if dtype is object}):
+                chunk, widen = _type_chunk(chunk, schema, dates, time_components)
+                if widen:
+                    return widen
+                writer.append(chunk)
+                if progress is not None:
+                    progress(min(f.tell() / total, 1))
+    else:
+        schema = None
+        for chunk, done in _excel_chunks(path, chunksize):
+            if schema is None:
+                schema = _upload_schema(chunk.infer_objects(), dates,
+                                        time_components, text)
+            chunk, widen = _type_chunk(chunk, schema, dates, time_components)
+            if widen:
+                return widen
+            writer.append(chunk)
+            if progress is not None:
+                progress(done)
+    return []
+
+def factorize_groups(df, groupby):
+    """
+    group code of every row and the keys of every group
+
+    Keys are sorted like a pandas groupby and rows with a missing key get
+    code -1. Repeated columns in `groupby` appear once in the keys.
+    """
+    combo = list(OrderedDict.fromkeys(groupby))
+    codes, levels = [], []
+    for col in combo:
+        c, uniques = pd.factorize(df[col], sort=True)
+        codes.append(c)
+        levels.append(uniques)
+    shape = [max(len(l), 1) for l in levels]
+    valid = np.all([c >= 0 for c in codes], axis=0) if codes else \
+        np.ones(df.shape[0], dtype=bool)
+    flat = np.ravel_multi_index([c[valid] for c in codes], shape)
+    groups, inverse = np.unique(flat, return_inverse=True)
+    group = np.full(df.shape[0], -1, dtype=np.int64)
+    group[valid] = inverse
+    keys = np.unravel_index(groups, shape)
+    keys = pd.DataFrame(OrderedDict(
+        (col, pd.Index(l).take(k)) for col, l, k in zip(combo, levels, keys)))
+    return group, keys
+
+def aggregate_groups(df, groupby, aggregations):
+    """
+    single pass multi-aggregation over factorized group keys
+
+    Parameters
+    ----------
+    groupby: list
+        descriptor columns to group by
+    aggregations: list of (column, stat)
+        stat is 'count', 'sum', 'mean', 'std' or a quantile given as a float,
+        quantiles use linear interpolation like pandas
+
+    Returns
+    -------
+    agg: DataFrame
+        one row per group indexed by the group keys, one column per
+        (column, stat) pair
+    """
+    group, keys = factorize_groups(df, groupby)
+    n_groups = keys.shape[0]
+    rows = np.flatnonzero(group >= 0)
+    order = rows[np.argsort(group[rows], kind='mergesort')]
+    sorted_group = group[order]
+    starts = np.searchsorted(sorted_group, np.arange(n_groups))
+    result = OrderedDict()
+    for column in OrderedDict.fromkeys(c for c, _ in aggregations):
+        stats = [stat for c, stat in aggregations if c == column]
+        values = df[column].values.astype(float)[order]
+        present = ~np.isnan(values)
+        count = np.bincount(sorted_group[present], minlength=n_groups)
+        total = np.bincount(sorted_group[present], values[present],
+                            minlength=n_groups)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = total / count
+            if 'std' in stats:
+                dev = (values - mean[sorted_group])[present]
+                var = np.bincount(sorted_group[present], dev * dev,
+                                  minlength=n_groups) / (count - 1)
+        quantiles = [stat for stat in stats if not isinstance(stat, str)]
+        if quantiles:
+            # sort values within each group, missing values last
+            ranked = np.lexsort((np.isnan(values), values, sorted_group))
+            ranked = values[ranked]
+        for stat in stats:
+            if stat == 'count':
+                result[column, stat] = count
+            elif stat == 'sum':
+                result[column, stat] = total
+            elif stat == 'mean':
+                result[column, stat] = mean
+            elif stat == 'std':
+                result[column, stat] = np.where(count > 1, np.sqrt(var), np.nan)
+            else:
+                result[column, stat] = _sorted_quantile(ranked, starts, count, stat)
+    agg = pd.DataFrame(np.column_stack([result[a] for a in aggregations])
+                       if aggregations else None,
+                       index=pd.MultiIndex.from_arrays(
+                           [keys[c].values for c in groupby], names=groupby))
+    agg.columns = pd.Index(list(aggregations), tupleize_cols=False)
+    return agg
+
+def _sorted_quantile(ranked, starts, count, q):
+    """
+    q quantile of every group from values sorted within their group, the
+    count values of group i starting at ranked[starts[i]], with linear
+    interpolation like pandas
+    """
+    position = starts + q * np.maximum(count - 1, 0)
+    lo = np.floor(position).astype(np.int64)
+    hi = np.ceil(position).astype(np.int64)
+    lo_value = ranked[np.minimum(lo, len(ranked) - 1)] if len(ranked) else lo * np.nan
+    hi_value = ranked[np.minimum(hi, len(ranked) - 1)] if len(ranked) else hi * np.nan
+    with np.errstate(invalid='ignore'):
+        value = np.where(hi > lo, lo_value + (position - lo) *
+                         (hi_value - lo_value), lo_value)
+    return np.where(count > 0, value, np.nan)
+
+class StatsCube:
+    """
+    per-group statistics of a dataset for every descriptor combination
+
+    For each combination of descriptors and each time column the cube keeps
+    counts, sums and sums of squares of volume and time together with the
+    rates (volume / hours) sorted within every group, so the opportunity
+    table for any grouping and quantile target is answered from the cube
+    instead of a groupby over the raw rows. Quantiles are exact, an
+    approximate sketch is not used because the opportunity takes the
+    difference of two quantiles and magnifies their error. Combinations are
+    computed on first use (all time columns in one pass) or up front with
+    build().
+    """
+    def __init__(self, df, descriptors, time_components,
+                 volume_column='Parent Batch Actual Qty'):
+        self.df = df
+        self.descriptors = list(descriptors)
+        self.time_components = list(time_components)
+        self.volume_column = volume_column
+        self.cells = {}
+
+    @property
+    def nbytes(self):
+        """
+        bytes of the computed cells, the dataset is accounted for by itself
+        """
+        return _nbytes(self.cells)
+
+    def build(self, depth=3):
+        """
+        precompute every combination of up to `depth` descriptors
+        """
+        for size in range(1, depth + 1):
+            for combo in itertools.combinations(sorted(self.descriptors), size):
+                self.cell(combo, self.time_components[0])
+        return self
+
+    def _hours(self, column):
+        return _numeric(self.df[column])
+
+    def _compute(self, combo):
+        group, keys = factorize_groups(self.df, list(combo))
+        valid = group >= 0
+        group = group[valid]
+        groups = keys.index
+        volume = self.df[self.volume_column].values.astype(float)[valid]
+        cells = {}
+        for time_column in self.time_components:
+            hours = self._hours(time_column)[valid]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rate = volume / hours
+            ok = ~(np.isnan(rate) | np.isnan(volume) | np.isnan(hours))
+            g, v, h, r = group[ok], volume[ok], hours[ok], rate[ok]
+            n = len(groups)
+            count = np.bincount(g, minlength=n)
+            cells[time_column] = {
+                'count': count,
+                'volume_sum': np.bincount(g, v, minlength=n),
+                'volume_sumsq': np.bincount(g, v * v, minlength=n),
+                'time_sum': np.bincount(g, h, minlength=n),
+                'time_sumsq': np.bincount(g, h * h, minlength=n),
+                'rates': r[np.lexsort((r, g))],
+                'starts': np.concatenate([[0], np.cumsum(count)[:-1]]),
+            }
+        return keys, cells
+
+    def cell(self, groupby, time_column):
+        """
+        group keys and statistics for a grouping and time column
+        """
+        combo = tuple(sorted(set(groupby)))
+        if combo not in self.cells:
+            self.cells[combo] = self._compute(combo)
+        keys, cells = self.cells[combo]
+        return keys, cells[time_column]
+
+    def quantile(self, cell, q):
+        """
+        q quantile of the rate in every group of a cell
+        """
+        return _sorted_quantile(cell['rates'], cell['starts'], cell['count'], q)
+
+    def opportunity(self, groupby, time_column, quant_target=0.75):
+        """
+        opportunity table of a grouping answered from the cube, with the
+        median, target quantile, sum, std and mean columns the
+        opportunity-table expects
+        """
+        keys, cell = self.cell(groupby, time_column)
+        n = cell['count'].astype(float)
+        target = '{:.0%}'.format(quant_target)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            columns = [('50%', self.quantile(cell, 0.5)),
+                       (target, self.quantile(cell, quant_target))]
+            for name, prefix in [(self.volume_column, 'volume'),
+                                 (time_column, 'time')]:
+                total = cell[prefix + '_sum']
+                var = (cell[prefix + '_sumsq'] - total * total / n) / (n - 1)
+                columns += [((name, 'sum'), total),
+                            ((name, 'std'), np.sqrt(np.maximum(var, 0))),
+                            ((name, 'mean'), total / n)]
+        desc = pd.DataFrame(np.column_stack([c[1] for c in columns]),
+                            index=pd.MultiIndex.from_arrays(
+                                [keys[col].values for col in groupby], names=groupby))
+        desc.columns = pd.Index([c[0] for c in columns], tupleize_cols=False)
+        desc['Count'] = cell['count']
+        desc = desc.loc[cell['count'] > 1].dropna()
+        desc['Volume Opportunity, Gal'] = (desc[self.volume_column, 'sum'] / desc['50%'] * desc[target]) - desc[self.volume_column, 'sum']
+        desc['Time Opportunity, Hours'] = desc[time_column, 'sum'] - (desc[time_column, 'sum'] / desc[target] * desc['50%'])
+        desc = desc.sort_values(by=[('Time Opportunity, Hours')], ascending=False)
+        return desc
+
+def get_stats_cube(key, descriptors, time_components,
+                   volume_column='Parent Batch Actual Qty', max_cubes=4):
+    """
+    memoized StatsCube of a registered dataset
+
+    Cells are added to a cube as they are used, so its size is taken again
+    on every lookup.
+    """
+    cube_key = (key, tuple(descriptors), tuple(time_components), volume_column)
+    cube = _cache_lookup('cubes', cube_key)
+    if cube is None:
+        cube = StatsCube(decode_dataset(key), descriptors, time_components,
+                         volume_column)
+    return _cache_store('cubes', cube_key, cube, size=max_cubes)
+
+def _request_dir(token, component):
+    return os.path.join(DATASET_DIR, 'requests',
+                        _digest(token.get('session'), component))
+
+def _expire(folder, max_age=None):
+    """
+    remove the files and folders in folder that were not modified for
+    max_age seconds, defaults to REQUEST_TTL
+    """
+    max_age = REQUEST_TTL if max_age is None else max_age
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return
+    cutoff = time.time() - max_age
+    for name in names:
+        path = os.path.join(folder, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+        except OSError:
+            pass
+
+def claim_request(token, component):
+    """
+    register a stamped request as the newest of its session and component,
+    False when a newer one was already seen so the caller can drop it
+
+    token is the {'session', 'time'} stamp the browser attaches to debounced
+    relayout events; the stamps are files shared by every server process.
+    Requests without a token always go ahead. Folders idle for
+    PPG_REQUEST_TTL seconds are removed, checked at most once a minute.
+    """
+    global _REQUESTS_EXPIRED
+    if not token:
+        return True
+    if time.time() - _REQUESTS_EXPIRED > 60:
+        _REQUESTS_EXPIRED = time.time()
+        _expire(os.path.join(DATASET_DIR, 'requests'))
+    folder = _request_dir(token, component)
+    os.makedirs(folder, exist_ok=True)
+    stamp = int(token['time'])
+    for name in os.listdir(folder):
+        if int(name) > stamp:
+            return False
+        if int(name) < stamp:
+            try:
+                os.remove(os.path.join(folder, name))
+            except OSError:
+                pass
+    open(os.path.join(folder, str(stamp)), 'a').close()
+    return True
+
+def superseded(token, component):
+    """
+    True once a newer request of the same session and component was claimed
+    """
+    if not token:
+        return False
+    try:
+        return any(int(name) > int(token['time'])
+                   for name in os.listdir(_request_dir(token, component)))
+    except OSError:
+        return False
+
+def opportunity_table(key, descriptors, time_components, volume_column,
+                      groupby, time_column, quant_target=0.75, progress=None):
+    """
+    opportunity of one grouping from the dataset's StatsCube, as a job
+    """
+    cube = get_stats_cube(key, descriptors, time_components, volume_column)
+    if progress is not None:
+        progress(0.5)
+    return cube.opportunity(groupby, time_column, quant_target)
+
+def _job_path(job_id, extension='json'):
+    # job ids come back from the browser, only ever join digests
+    if not _is_key(job_id):
+        raise KeyError('unknown job: {}'.format(job_id))
+    return os.path.join(DATASET_DIR, 'jobs', '{}.{}'.format(job_id, extension))
+
+def _set_job_status(job_id, state, progress, **entry):
+    write_manifest(_job_path(job_id), dict(entry, id=job_id, state=state,
+                   progress=progress, pid=os.getpid(), time=time.time()))
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _run_job(job_id, func, args):
+    _set_job_status(job_id, 'running', 0)
+    try:
+        result = func(*args, progress=lambda done:
+                      _set_job_status(job_id, 'running', done))
+        tmp = _job_path(job_id, 'pkl.{}.tmp'.format(os.getpid()))
+        pd.to_pickle(result, tmp)
+        os.replace(tmp, _job_path(job_id, 'pkl'))
+    except Exception as e:
+        _set_job_status(job_id, 'error', None, error=repr(e))
+        return
+    _set_job_status(job_id, 'done', 1)
+
+def _job_crashed(job_id, future):
+    # a worker that dies takes the job with it before it can record an error
+    error = future.exception()
+    if error is not None:
+        _set_job_status(job_id, 'error', None, error=repr(error))
+
+def _evict_jobs(keep=None):
+    """
+    remove the status and result files of all but the keep newest finished
+    jobs, keep defaults to JOB_HISTORY
+    """
+    keep = JOB_HISTORY if keep is None else keep
+    folder = os.path.join(DATASET_DIR, 'jobs')
+    try:
+        names = [name for name in os.listdir(folder) if name.endswith('.json')]
+    except OSError:
+        return
+    finished = []
+    for name in names:
+        status = read_manifest(os.path.join(folder, name))
+        if (status is not None) and (status['state'] in ['done', 'error']):
+            finished.append((status['time'], status['id']))
+    for _, job_id in sorted(finished, reverse=True)[keep:]:
+        for extension in ['json', 'pkl']:
+            try:
+                os.remove(_job_path(job_id, extension))
+            except OSError:
+                pass
+
+def submit_job(func, *args):
+    """
+    run func(*args, progress=callable) in the local worker pool
+
+    The job id is a hash of the function and its arguments, so a job that
+    is already running or finished, in any server process, is not started
+    again and its result is reused. A job whose worker died or that has not
+    reported for PPG_JOB_TIMEOUT seconds is failed and can be submitted
+    again. Only the newest PPG_JOB_HISTORY finished jobs are kept. Jobs run
+    inline when PPG_JOB_WORKERS is 0.
+
+    Returns
+    -------
+    job_id: str
+        id for job_status and job_result
+    """
+    global _JOB_POOL
+    job_id = _digest(func.__module__, func.__name__, args)
+    status = job_status(job_id)
+    if status is not None:
+        if (status['state'] == 'done') and os.path.exists(_job_path(job_id, 'pkl')):
+            return job_id
+        if status['state'] in ['started', 'running']:
+            return job_id
+    _evict_jobs()
+    if JOB_WORKERS == 0:
+        _run_job(job_id, func, args)
+        return job_id
+    _set_job_status(job_id, 'started', 0)
+    with _DATASET_LOCK:
+        if _JOB_POOL is None:
+            _JOB_POOL = concurrent.futures.ProcessPoolExecutor(JOB_WORKERS)
+        pool = _JOB_POOL
+    try:
+        future = pool.submit(_run_job, job_id, func, args)
+    except concurrent.futures.process.BrokenProcessPool:
+        with _DATASET_LOCK:
+            if _JOB_POOL is pool:
+                _JOB_POOL = concurrent.futures.ProcessPoolExecutor(JOB_WORKERS)
+            pool = _JOB_POOL
+        future = pool.submit(_run_job, job_id, func, args)
+    future.add_done_callback(lambda future: _job_crashed(job_id, future))
+    return job_id
+
+def job_status(job_id):
+    """
+    status record of a job, state is started, running, done or error
+
+    A started or running job is reported as an error once the process
+    that last updated it is gone or it has not reported for JOB_TIMEOUT
+    seconds, so pollers stop waiting on it.
+    """
+    status = read_manifest(_job_path(job_id))
+    if (status is None) or (status['state'] not in ['started', 'running']):
+        return status
+    if not _pid_alive(status['pid']):
+        error = 'job process {} exited'.format(status['pid'])
+    elif time.time() - status['time'] > JOB_TIMEOUT:
+        error = 'job timed out after {:.0f} s'.format(JOB_TIMEOUT)
+    else:
+        return status
+    _set_job_status(job_id, 'error', None, error=error)
+    return read_manifest(_job_path(job_id))
+
+def job_result(job_id):
+    """
+    return value of a finished job
+    """
+    return pd.read_pickle(_job_path(job_id, 'pkl'))
+
+def cached_figure(view, key, inputs, build):
+    """
+    figure dict of build(), memoized on a view name, dataset key and the
+    inputs that determine the figure, with LRU eviction past
+    FIGURE_CACHE_SIZE entries or the shared DATASET_CACHE_BYTES
+    """
+    digest = _digest(view, key, inputs)
+    figure = _cache_lookup('figures', digest)
+    with _DATASET_LOCK:
+        _FIGURE_STATS['hits' if figure is not None else 'misses'] += 1
+    if figure is not None:
+        return figure
+    figure = build()
+    if hasattr(figure, 'to_dict'):
+        figure = figure.to_dict()
+    return _cache_store('figures', digest, figure, size=FIGURE_CACHE_SIZE)
+
+def figure_cache_info():
+    """
+    hits, misses and size of the figure cache
+    """
+    with _DATASET_LOCK:
+        return dict(_FIGURE_STATS, size=len(_FIGURES), maxsize=FIGURE_CACHE_SIZE)
+
+class InvertedIndex:
+    """
+    sorted row positions of every value of one dataset column
+
+    Parameters
+    ----------
+    column: Series
+        categorical or hashable values, missing values are not indexed
+    """
+    def __init__(self, column):
+        codes, values = pd.factorize(column)
+        self.size = codes.shape[0]
+        self.order = np.argsort(codes, kind='mergesort')
+        counts = np.bincount(codes[codes >= 0], minlength=len(values))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]) + (codes < 0).sum()
+        self.positions = {value: i for i, value in enumerate(values)}
+        self.notnull = np.sort(self.order[self.offsets[0]:])
+
+    def rows(self, values):
+        """
+        sorted row positions holding any of values
+        """
+        ids = sorted({self.positions[v] for v in values if v in self.positions})
+        if len(ids) == len(self.positions):
+            return self.notnull
+        postings = [self.order[self.offsets[i]:self.offsets[i + 1]] for i in ids]
+        if len(postings) == 1:
+            return postings[0]
+        return np.sort(np.concatenate(postings + [np.array([], dtype=np.intp)]))
+
+    def mask(self, values):
+        """
+        boolean row bitmap of values, combine bitmaps with | and &
+        """
+        return _row_mask(self.size, self.rows(values))
+
+def _row_mask(size, rows):
+    mask = np.zeros(size, dtype=bool)
+    mask[rows] = True
+    return mask
+
+class DateIndex:
+    """
+    rows of one datetime column in date order, so a window of dates is a
+    searchsorted slice; missing dates are not indexed
+    """
+    def __init__(self, column):
+        values = np.asarray(column.values, dtype='datetime64[ns]')
+        order = np.argsort(values, kind='mergesort')
+        valid = ~np.isnat(values[order])
+        self.order = order[valid]
+        self.dates = values[self.order]
+
+    def window(self, start, end):
+        """
+        row positions with start < date < end, in date order
+        """
+        low = np.searchsorted(self.dates, np.datetime64(start, 'ns'), 'right')
+        high = np.searchsorted(self.dates, np.datetime64(end, 'ns'), 'left')
+        return self.order[low:max(low, high)]
+
+def _memoized(name, cache_key, build, size):
+    value = _cache_lookup(name, cache_key)
+    if value is None:
+        value = _cache_store(name, cache_key, build(), size=size)
+    return value
+
+def inverted_index(key, column, max_indexes=32):
+    """
+    memoized InvertedIndex of one column of a registered dataset
+    """
+    return _memoized('indexes', (key, column, 'values'),
+                     lambda: InvertedIndex(decode_dataset(key)[column]), max_indexes)
+
+def date_index(key, column, max_indexes=32):
+    """
+    memoized DateIndex of one datetime column of a registered dataset
+    """
+    return _memoized('indexes', (key, column, 'dates'),
+                     lambda: DateIndex(decode_dataset(key)[column]), max_indexes)
+
+def filtered_view(key, filter_category, filter_selected, time_column,
+                  window=None, volume_column='Parent Batch Actual Qty',
+                  date_column='TO.80 Log Date', clip=0.997, max_views=32):
+    """
+    row positions of a dataset left by the dashboard filters, memoized so
+    the callbacks of one interaction share a single filter pass
+
+    Rows are kept when filter_category is in filter_selected and the
+    volume by time rate is finite and below its `clip` quantile. A window
+    (start, end) then keeps rows with date_column strictly inside it.
+    The selection comes from the column's inverted index and the window
+    from the date index, so only the selected rows are read.
+    """
+    if isinstance(filter_selected, str):
+        filter_selected = [filter_selected]
+    view_key = (key, filter_category, tuple(filter_selected), time_column,
+                volume_column, clip)
+    if window is not None:
+        base = filtered_view(key, filter_category, filter_selected, time_column,
+                             None, volume_column, date_column, clip, max_views)
+        mask = _memoized('views', view_key + ('mask',),
+                         lambda: _row_mask(decode_dataset(key).shape[0], base),
+                         max_views)
+        return _memoized('views', view_key + (date_column, tuple(window)),
+                         lambda: _window_rows(key, date_column, window, mask),
+                         max_views)
+    return _memoized('views', view_key,
+                     lambda: _filter_rows(key, filter_category, filter_selected,
+                                          time_column, volume_column, clip),
+                     max_views)
+
+def _filter_rows(key, filter_category, filter_selected, time_column,
+                 volume_column, clip):
+    df = decode_dataset(key)
+    index = inverted_index(key, filter_category).rows(filter_selected)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = df[volume_column].values[index] /\
+            (df[time_column].values[index] / np.timedelta64(1, 's')/60/60)
+    keep = rate < np.inf
+    if keep.any():
+        keep &= rate < np.quantile(rate[keep], clip)
+    return index[keep]
+
+def _window_rows(key, date_column, window, mask):
+    rows = date_index(key, date_column).window(*window)
+    return np.sort(rows[mask[rows]])
+
+def view_dataset(key, filter_category, filter_selected, time_column,
+                 window=None, volume_column='Parent Batch Actual Qty', **kwargs):
+    """
+    copy of the filtered rows of a dataset with the rate column
+    "<volume_column> By <time_column>" added
+    """
+    index = filtered_view(key, filter_category, filter_selected, time_column,
+                          window, volume_column, **kwargs)
+    df = decode_dataset(key).take(index)
+    df["{} By {}".format(volume_column, time_column)] = df[volume_column] /\
+        (df[time_column].dt.total_seconds()/60/60)
+    return df
+
+DATA_FUNCTIONS = {'decode_dataset', 'get_dataset', 'view_dataset',
+                  'filtered_view', 'register_dataset', 'ingest_preset',
+                  'spool_upload', 'ingest_upload', 'get_stats_cube',
+                  'scan_opportunities',
+                  'submit_job', 'job_status', 'job_result', 'cached_figure'}
+
+def _touches_data(code, namespace, seen):
+    names = set(code.co_names)
+    if names & DATA_FUNCTIONS:
+        return True
+    for const in code.co_consts:
+        if hasattr(const, 'co_names') and _touches_data(const, namespace, seen):
+            return True
+    for name in names - seen:
+        seen.add(name)
+        func = namespace.get(name)
+        if hasattr(func, '__code__') and _touches_data(func.__code__, func.__globals__, seen):
+            return True
+    return False
+
+def audit_callbacks(app):
+    """
+    outputs of server callbacks that never reach the dataset store
+
+    Every name a callback references is followed through the functions it
+    calls; a callback that cannot reach any of DATA_FUNCTIONS only reshapes
+    UI state and is a candidate for a clientside callback.
+    """
+    flagged = []
+    for output, entry in app.callback_map.items():
+        if 'callback' not in entry:
+            continue
+        func = getattr(entry['callback'], '__wrapped__', entry['callback'])
+        if not _touches_data(func.__code__, func.__globals__, set()):
+            flagged.append(output)
+    return flagged
+
+def _scan_combination(key, groupby, time_components, volume_column,
+                      quant_targets, top):
+    """
+    opportunity of every group of one descriptor combination, for all time
+    columns and quantile targets in one aggregation
+    """
+    df = decode_dataset(key)
+    frame = pd.DataFrame(OrderedDict((col, df[col]) for col in groupby))
+    volume = df[volume_column].values.astype(float)
+    aggregations = []
+    for i, time_column in enumerate(time_components):
+        hours = df[time_column]
+        hours = hours.dt.total_seconds().values / 60 / 60 \
+            if hours.dtype.kind == 'm' else hours.values.astype(float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = volume / hours
+        invalid = np.isnan(rate) | np.isnan(volume) | np.isnan(hours)
+        for name, values in [('rate', rate), ('hours', hours), ('volume', volume)]:
+            frame['{} {}'.format(name, i)] = np.where(invalid, np.nan, values)
+        aggregations += [('rate {}'.format(i), q) for q in [0.5] + list(quant_targets)]
+        aggregations += [('hours {}'.format(i), 'sum'), ('hours {}'.format(i), 'std'),
+                         ('volume {}'.format(i), 'sum'), ('volume {}'.format(i), 'std'),
+                         ('volume {}'.format(i), 'count')]
+    agg = aggregate_groups(frame, list(groupby), aggregations)
+    results = []
+    for i, time_column in enumerate(time_components):
+        median = agg['rate {}'.format(i), 0.5].values
+        hours = agg['hours {}'.format(i), 'sum'].values
+        volume = agg['volume {}'.format(i), 'sum'].values
+        count = agg['volume {}'.format(i), 'count'].values
+        valid = ~(np.isnan(agg['hours {}'.format(i), 'std'].values) |
+                  np.isnan(agg['volume {}'.format(i), 'std'].values))
+        target = np.column_stack([agg['rate {}'.format(i), q].values
+                                  for q in quant_targets])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            time_opportunity = hours[:, None] - hours[:, None] / target * median[:, None]
+            volume_opportunity = volume[:, None] / median[:, None] * target - volume[:, None]
+        time_opportunity[~valid] = np.nan
+        group, q = [], []
+        for j in range(len(quant_targets)):
+            finite = np.flatnonzero(np.isfinite(time_opportunity[:, j]))
+            best = np.argsort(-time_opportunity[finite, j], kind='mergesort')[:top]
+            group.append(finite[best])
+            q.append(np.full(len(best), j))
+        group, q = np.concatenate(group), np.concatenate(q)
+        result = pd.DataFrame(OrderedDict(
+            [('Primary', groupby[0]), ('Secondary', groupby[1]),
+             ('Tertiary', groupby[2])] +
+            [('{} Value'.format(level), agg.index.get_level_values(j).values[group])
+             for j, level in enumerate(['Primary', 'Secondary', 'Tertiary'])] +
+            [('Time Column', time_column),
+             ('Quantile Target', np.asarray(quant_targets)[q]),
+             ('Count', count[group].astype(int)),
+             ('{}, sum'.format(volume_column), volume[group]),
+             ('{}, sum'.format('Hours'), hours[group]),
+             ('Volume Opportunity, Gal', volume_opportunity[group, q]),
+             ('Time Opportunity, Hours', time_opportunity[group, q])]))
+        for col in ['Primary Value', 'Secondary Value', 'Tertiary Value']:
+            result[col] = result[col].astype(object)
+        results.append(result)
+    return pd.concat(results, ignore_index=True)
+
+def scan_opportunities(key, descriptors, time_components,
+                       volume_column='Parent Batch Actual Qty',
+                       quant_targets=(0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95),
+                       top=100, progress=None):
+    """
+    rank the opportunity of every descriptor triple within each time column
+    and quantile target of a dataset
+
+    Time Opportunity grows with the quantile target and with the length of
+    the time column, so rows are only ranked against rows of the same time
+    column and target. Ordered triples that are permutations of each other
+    give the same groups, so every set of three descriptors is evaluated
+    once. Meant to run as a job through submit_job, whose result is reused
+    for the same dataset and parameters.
+
+    Parameters
+    ----------
+    key: str
+        dataset key
+    quant_targets: sequence of float
+        target quantiles the median rate is compared against
+    top: int, default 100
+        number of ranked rows kept per time column and quantile target
+    progress: callable, optional
+        called with the fraction of descriptor triples done
+
+    Returns
+    -------
+    ranked: DataFrame
+        top rows by Time Opportunity, Hours of every time column and
+        quantile target, with their grouping and Rank within them
+    """
+    quant_targets = [float(q) for q in quant_targets]
+    combos = list(itertools.combinations(descriptors, 3))
+    results = []
+    for i, combo in enumerate(combos):
+        results.append(_scan_combination(key, combo, list(time_components),
+                                         volume_column, quant_targets, top))
+        if progress is not None:
+            progress((i + 1) / len(combos))
+    ranked = pd.concat(results, ignore_index=True)
+    ranked = ranked.sort_values('Time Opportunity, Hours', ascending=False,
+                                kind='mergesort')
+    ranked = ranked.groupby(['Time Column', 'Quantile Target'], sort=False)\
+        .head(top).reset_index(drop=True)
+    ranked.insert(0, 'Rank', ranked.groupby(['Time Column', 'Quantile Target'])
+                  .cumcount().values + 1)
+    return ranked